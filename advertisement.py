@@ -19,6 +19,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import logging
 import dbus
 import dbus.service
 
@@ -30,6 +31,8 @@ DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
 LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 
+logger = logging.getLogger(__name__)
+
 
 class Advertisement(dbus.service.Object):
     PATH_BASE = "/org/bluez/example/advertisement"
@@ -44,6 +47,7 @@ class Advertisement(dbus.service.Object):
         self.manufacturer_data = None
         self.service_data = None
         self.include_tx_power = None
+        self.registered = False
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
@@ -102,6 +106,21 @@ class Advertisement(dbus.service.Object):
             self.local_name = ""
         self.local_name = dbus.String(name)
 
+    def update_service_data(self, uuid, data):
+        """
+        Replaces the service data for `uuid` and tells BlueZ through
+        PropertiesChanged, which updates the advertisement in place.
+        """
+        self.add_service_data(uuid, data)
+        if self.registered:
+            self.PropertiesChanged(LE_ADVERTISEMENT_IFACE,
+                                   {"ServiceData": self.service_data}, [])
+
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature="s",
                          out_signature="a{sv}")
@@ -115,20 +134,35 @@ class Advertisement(dbus.service.Object):
                          in_signature='',
                          out_signature='')
     def Release(self):
-        print ('%s: Released!' % self.path)
+        logger.info(f"{self.path}: Released!")
 
     def register_ad_callback(self):
-        print("GATT advertisement registered")
+        self.registered = True
+        logger.info("GATT advertisement registered")
 
-    def register_ad_error_callback(self):
-        print("Failed to register GATT advertisement")
+    def register_ad_error_callback(self, error=None):
+        logger.error(f"Failed to register GATT advertisement: {error}")
 
-    def register(self):
-        bus = BleTools.get_bus()
-        adapter = BleTools.find_adapter(bus)
+    def get_ad_manager(self):
+        adapter = BleTools.find_adapter(self.bus)
 
-        ad_manager = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                                LE_ADVERTISING_MANAGER_IFACE)
+        return dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, adapter),
+                              LE_ADVERTISING_MANAGER_IFACE)
+
+    def register(self):
+        ad_manager = self.get_ad_manager()
         ad_manager.RegisterAdvertisement(self.get_path(), {},
                                      reply_handler=self.register_ad_callback,
                                      error_handler=self.register_ad_error_callback)
+
+    def reregister(self):
+        """
+        Registers the advertisement again so BlueZ picks up changed data, for
+        BlueZ versions that ignore PropertiesChanged on advertisements.
+        """
+        if not self.registered:
+            return
+        self.registered = False
+        self.get_ad_manager().UnregisterAdvertisement(self.get_path(),
+                reply_handler=self.register,
+                error_handler=self.register_ad_error_callback)
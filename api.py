@@ -1,77 +1,157 @@
-import coloredlogs
 import json
-import requests
 import logging
-
-BLYQT_API_PREFIX = "http://0.0.0.0:8000/api/v1"
+import os
+import threading
+import time
+
+from metrics import metrics
+
+BLYQT_API_PREFIX = os.environ.get("BLYQT_API_PREFIX", "http://0.0.0.0:8000/api/v1")
+
+SETTINGS_RECORDING_PATH = "/liteunit/settings/recording"
+SETTINGS_MISCELLANEOUS_PATH = "/liteunit/settings/miscellaneous"
+RECORDING_START_PATH = "/liteunit/recording/front/start"
+RECORDING_STOP_PATH = "/liteunit/recording/front/stop"
+FRONT_LIVE_START_PATH = "/liteunit/live/front/start"
+FRONT_LIVE_STOP_PATH = "/liteunit/live/front/stop"
+EYE_LIVE_START_PATH = "/liteunit/live/eye/start"
+EYE_LIVE_STOP_PATH = "/liteunit/live/eye/stop"
+
+# (connect, read) timeouts in seconds
+BLYQT_DEFAULT_TIMEOUT = (1.0, 5.0)
+BLYQT_TIMEOUTS = {
+    RECORDING_START_PATH: (1.0, 10.0),
+    RECORDING_STOP_PATH: (1.0, 10.0),
+}
+BLYQT_RETRIES = 2
+BLYQT_RETRY_BACKOFF = 0.2
+BLYQT_POOL_SIZE = 4
+
+# BLE settings key: recorder API field, per settings section
+RECORDING_SETTINGS_FIELDS = {
+    "gazeoverlay": "gaze_overlay",
+    "gazefile": "gaze_file",
+    "audio": "audio",
+    "heatmap": "heat_map",
+    "location": "location",
+    "container": "file_format",
+    "fc_resolution": "front_resolution",
+}
+MISCELLANEOUS_SETTINGS_FIELDS = {
+    "buzzer": "buzzer_on",
+}
 
 
 logger = logging.getLogger(__name__)
-coloredlogs.install(level=logging.DEBUG, logger=logger)
 
 
 def update_blyqt_recording_settings(updated_settings_json):
-    URL = f"{BLYQT_API_PREFIX}/liteunit/settings/recording"
-    payload = {
-        "gaze_overlay": updated_settings_json["recording"]["gazeoverlay"],
-        "gaze_file": updated_settings_json["recording"]["gazefile"],
-        "audio": updated_settings_json["recording"]["audio"],
-        "heat_map": updated_settings_json["recording"]["heatmap"],
-        "location": updated_settings_json["recording"]["location"],
-        "file_format": updated_settings_json["recording"]["container"],
-        "front_resolution": updated_settings_json["recording"]["fc_resolution"]
-    }
-    return blyqt_send_post_request(URL, payload)
+    settings = updated_settings_json["recording"]
+    payload = {field: settings[key] for key, field in RECORDING_SETTINGS_FIELDS.items()}
+    return get_client().post(SETTINGS_RECORDING_PATH, payload)
 
 
 def update_blyqt_miscellaneous_settings(updated_settings_json):
-    URL = f"{BLYQT_API_PREFIX}/liteunit/settings/miscellaneous"
-    payload = {
-        "buzzer_on": updated_settings_json["hmi"]["buzzer"],
-        "glasses_led": "continuous-blinking",  # TODO: retrieve from JS
-    }
-    return blyqt_send_post_request(URL, payload)
+    settings = updated_settings_json["hmi"]
+    payload = {field: settings[key] for key, field in MISCELLANEOUS_SETTINGS_FIELDS.items()}
+    payload["glasses_led"] = "continuous-blinking"  # TODO: retrieve from JS
+    return get_client().post(SETTINGS_MISCELLANEOUS_PATH, payload)
+
+
+class BlyqtClient(object):
+    """
+    Keep-alive HTTP client for the Blyqt recorder API. Connections are pooled,
+    every endpoint has a (connect, read) timeout, and connection failures are
+    retried a bounded number of times with backoff.
+    """
+    def __init__(self, prefix=BLYQT_API_PREFIX, timeouts=None, retries=BLYQT_RETRIES,
+                 backoff=BLYQT_RETRY_BACKOFF, pool_size=BLYQT_POOL_SIZE):
+        self.prefix = prefix
+        # requests is imported on first use; it takes long to import on a Pi Zero
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        self.timeouts = dict(BLYQT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.session = requests.Session()
+        self.session.headers.update({"Content-Type": "application/json",
+                                     "accept": "application/json"})
+        self.session.verify = False
+        retry = Retry(total=retries, connect=retries, read=0, status=0,
+                      backoff_factor=backoff)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def post(self, path, payload=None):
+        start = time.monotonic()
+        ok = self.send_post_request(self.prefix + path, payload,
+                                    self.timeouts.get(path, BLYQT_DEFAULT_TIMEOUT))
+        metrics.observe(path, "post", time.monotonic() - start, not ok)
+        return ok
+
+    def send_post_request(self, endpoint, payload=None, timeout=BLYQT_DEFAULT_TIMEOUT):
+        import requests
+
+        logger.debug("endpoint=%s", endpoint)
+        try:
+            if payload:
+                response = self.session.post(endpoint, json=payload, timeout=timeout)
+            else:
+                response = self.session.post(endpoint, timeout=timeout)
+        except requests.RequestException as e:
+            logger.error(f"HTTP POST request to {endpoint} failed: {e}")
+            return False
+        logger.info("HTTP POST request send, got: %s", response)
+        return response.status_code == 200
+
+    def close(self):
+        self.session.close()
+
+
+client = None
+client_lock = threading.Lock()
+
+
+def get_client():
+    global client
+    with client_lock:
+        if client is None:
+            client = BlyqtClient()
+    return client
 
 
 def blyqt_send_post_request(endpoint="", payload=None):
     if not endpoint:
         logger.fatal(f"Provide a valid endpoint to send request, got: `{endpoint}`")
-    headers = {"Content-Type": "application/json",
-               "accept": "application/json"}
-    logger.debug(f"{endpoint=}")
-    if payload:
-        response = requests.post(endpoint, json=payload, headers=headers, verify=False)
-    else:
-        response = requests.post(endpoint, headers=headers, verify=False)
-    logger.info(f"HTTP POST request send, got: {response}")
-    return response.status_code == 200
+    blyqt = get_client()
+    if endpoint.startswith(blyqt.prefix):
+        return blyqt.post(endpoint[len(blyqt.prefix):], payload)
+    return blyqt.send_post_request(endpoint, payload)
 
 
 def blyqt_start_recording():
-    URL = f"{BLYQT_API_PREFIX}/liteunit/recording/front/start"
-    return blyqt_send_post_request(URL)
+    return get_client().post(RECORDING_START_PATH)
 
 
 def blyqt_stop_recording():
-    URL = f"{BLYQT_API_PREFIX}/liteunit/recording/front/stop"
-    return blyqt_send_post_request(URL)
+    return get_client().post(RECORDING_STOP_PATH)
 
 
 def blyqt_start_front_live():
-    URL = f"{BLYQT_API_PREFIX}/liteunit/live/front/start"
-    return blyqt_send_post_request(URL)
+    return get_client().post(FRONT_LIVE_START_PATH)
 
 
 def blyqt_stop_front_live():
-    URL = f"{BLYQT_API_PREFIX}/liteunit/live/front/stop"
-    return blyqt_send_post_request(URL)
+    return get_client().post(FRONT_LIVE_STOP_PATH)
 
 
 def blyqt_start_eye_live():
-    URL = f"{BLYQT_API_PREFIX}/liteunit/live/eye/start"
-    return blyqt_send_post_request(URL)
+    return get_client().post(EYE_LIVE_START_PATH)
 
 
 def blyqt_stop_eye_live():
-    URL = f"{BLYQT_API_PREFIX}/liteunit/live/eye/stop"
-    return blyqt_send_post_request(URL)
+    return get_client().post(EYE_LIVE_STOP_PATH)
@@ -0,0 +1,77 @@
+import logging
+import time
+import dbus
+
+logger = logging.getLogger(__name__)
+
+MCU_SERVICE_NAME = "io.vpsrecorder.mcucom"
+MCU_OBJECT_PATH = "/io/vpsrecorder/mcucom"
+MCU_IFACE = "io.vpsrecorder.mcucom"
+MCU_BATTERY_SIGNAL = "batterySOCChanged"
+BATTERY_CACHE_TTL = 10.0
+
+
+class BatteryMonitor(object):
+    """
+    Serves the MCU battery state of charge from memory. The value is refreshed
+    with a direct D-Bus call once it is older than `ttl` seconds, concurrent
+    readers share a single in-flight query, and MCU signals update the cache
+    without any query at all.
+    """
+    def __init__(self, bus, ttl=BATTERY_CACHE_TTL):
+        self.bus = bus
+        self.ttl = ttl
+        self.level = None
+        self.updated = None
+        self.pending = []
+        self.listeners = []
+        # Following the owner lets mcucom start after us or restart later
+        self.mcu = bus.get_object(MCU_SERVICE_NAME, MCU_OBJECT_PATH, introspect=False,
+                                  follow_name_owner_changes=True)
+        self.bus.add_signal_receiver(self.battery_changed,
+                signal_name=MCU_BATTERY_SIGNAL,
+                dbus_interface=MCU_IFACE,
+                path=MCU_OBJECT_PATH)
+
+    def is_fresh(self):
+        return self.updated is not None and time.monotonic() - self.updated < self.ttl
+
+    def get(self, callback, error_callback=None):
+        if self.is_fresh():
+            callback(self.level)
+            return
+
+        self.pending.append((callback, error_callback))
+        if len(self.pending) > 1:
+            return
+
+        self.mcu.getBatterySOC(dbus.Boolean(True),
+                dbus_interface=MCU_IFACE,
+                reply_handler=self.query_reply,
+                error_handler=self.query_error)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def battery_changed(self, level, *args):
+        self.update(level)
+
+    def update(self, level):
+        previous, self.level = self.level, int(level)
+        self.updated = time.monotonic()
+        if self.level != previous:
+            for listener in self.listeners:
+                listener(self.level)
+
+    def query_reply(self, level):
+        self.update(level)
+        pending, self.pending = self.pending, []
+        for callback, error_callback in pending:
+            callback(self.level)
+
+    def query_error(self, error):
+        logger.error(f"Battery query failed: {error}")
+        pending, self.pending = self.pending, []
+        for callback, error_callback in pending:
+            if error_callback:
+                error_callback(error)
@@ -0,0 +1,623 @@
+#!/usr/bin/python3
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from executor import CommandExecutor
+
+PROBE_INTERVAL_MS = 10
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+GATT_MTU = 247
+STARTUP_TIMEOUT = 30.0
+# Commands on the PATH of the service under test; hciconfig only has to succeed
+MOCK_COMMANDS = {
+    "hciconfig": "#!/bin/sh\nexit 0\n",
+    "nmcli": "#!/bin/sh\necho 'vps-lab:80:WPA2'\n",
+}
+TERMINAL_COMMAND = "head -c 4096 /dev/zero"
+PROVISIONING_SSID = b"vps-lab"
+PROVISIONING_PASSWORD = b"benchmark"
+PROVISIONING_STATES = ("queued", "associating", "dhcp", "connected")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 50),
+        "p99_ms": percentile(samples, 99),
+        "max_ms": max(samples) if samples else None,
+    }
+
+
+def bench_loop_latency(args):
+    """
+    Simulates a GATT read arriving every PROBE_INTERVAL_MS while a slow write
+    handler runs `args.command`, and reports how late each read is served.
+    """
+    results = {}
+    for mode in ("blocking", "executor"):
+        loop = GObject.MainLoop()
+        executor = CommandExecutor()
+        samples = []
+        state = {"expected": None}
+
+        def probe():
+            now = time.monotonic()
+            samples.append((now - state["expected"]) * 1000.0)
+            state["expected"] = now + PROBE_INTERVAL_MS / 1000.0
+            return True
+
+        def slow_write():
+            if mode == "blocking":
+                subprocess.run(args.command, shell=True)
+            else:
+                executor.run_command(args.command, callback=lambda result: None)
+            return False
+
+        state["expected"] = time.monotonic() + PROBE_INTERVAL_MS / 1000.0
+        GObject.timeout_add(PROBE_INTERVAL_MS, probe)
+        GObject.timeout_add(PROBE_INTERVAL_MS * 5, slow_write)
+        GObject.timeout_add(int(args.duration * 1000), loop.quit)
+        loop.run()
+        executor.shutdown()
+        results[mode] = summarize(samples)
+    return results
+
+
+def bench_startup(args):
+    """
+    Compares the legacy hciconfig-and-sleep bring-up with the readiness
+    driven start_bluetooth() on the local adapter. Needs root and BlueZ.
+    """
+    import dbus
+    import dbus.mainloop.glib
+    from bletools import BleTools
+    from main import start_bluetooth
+
+    legacy_commands = [
+        "hciconfig hci0 up",
+        "hciconfig hci0 piscan",
+        "hciconfig hci0 sspmode 1",
+    ]
+    results = {"legacy": [], "readiness": []}
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+    adapter = BleTools.find_adapter(bus)
+
+    def power_down():
+        # Both paths must start from an unpowered adapter, otherwise the
+        # second one finds it ready and returns at once
+        BleTools.set_adapter_property(bus, adapter, "Discoverable", dbus.Boolean(0))
+        BleTools.set_adapter_property(bus, adapter, "Powered", dbus.Boolean(0))
+
+    for _ in range(args.repeat):
+        power_down()
+        start = time.monotonic()
+        for command in legacy_commands:
+            subprocess.run(command, shell=True, check=True)
+            time.sleep(0.3)
+        results["legacy"].append((time.monotonic() - start) * 1000.0)
+
+        power_down()
+        start = time.monotonic()
+        start_bluetooth(bus)
+        results["readiness"].append((time.monotonic() - start) * 1000.0)
+    return {mode: summarize(samples) for mode, samples in results.items()}
+
+
+class StubBlyqtHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        body = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_http(args):
+    """
+    Measures start/stop-recording round trips against a local stub of the
+    Blyqt API, once with a fresh connection per request and once through
+    the pooled BlyqtClient.
+    """
+    import requests
+    from api import BlyqtClient, RECORDING_START_PATH, RECORDING_STOP_PATH
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBlyqtHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    prefix = "http://127.0.0.1:%d/api/v1" % server.server_address[1]
+
+    results = {"per-request": [], "pooled": []}
+    client = BlyqtClient(prefix=prefix)
+    for _ in range(args.repeat):
+        for path in (RECORDING_START_PATH, RECORDING_STOP_PATH):
+            start = time.monotonic()
+            requests.post(prefix + path, headers={"accept": "application/json"})
+            results["per-request"].append((time.monotonic() - start) * 1000.0)
+
+            start = time.monotonic()
+            client.post(path)
+            results["pooled"].append((time.monotonic() - start) * 1000.0)
+    client.close()
+    server.shutdown()
+    return {mode: summarize(samples) for mode, samples in results.items()}
+
+
+def run_throughput(send, duration):
+    """
+    Calls send() from the GLib loop for `duration` seconds and returns the
+    wall and process CPU time spent.
+    """
+    loop = GObject.MainLoop()
+    deadline = time.monotonic() + duration
+
+    def pump():
+        if time.monotonic() >= deadline:
+            loop.quit()
+            return False
+        send()
+        return True
+
+    wall, cpu = time.monotonic(), time.process_time()
+    GObject.idle_add(pump)
+    loop.run()
+    return time.monotonic() - wall, time.process_time() - cpu
+
+
+def throughput_result(received, wall, cpu):
+    return {
+        "bytes": received,
+        "bytes_per_s": received / wall,
+        "cpu_percent": cpu / wall * 100.0,
+    }
+
+
+def bench_throughput(args):
+    """
+    Streams notification-sized payloads through a PropertiesChanged signal
+    on the session bus and through an AcquireNotify style socketpair, and
+    reports the received bytes/s and the CPU used by this process.
+    """
+    import dbus
+    import dbus.service
+    import dbus.mainloop.glib
+
+    class Emitter(dbus.service.Object):
+        @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+        def PropertiesChanged(self, interface, changed, invalidated):
+            pass
+
+    payload = bytes(args.payload)
+    results = {}
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    emitter = Emitter(bus, "/benchmark/char0")
+    received = [0]
+
+    def on_signal(interface, changed, invalidated):
+        received[0] += len(changed["Value"])
+
+    bus.add_signal_receiver(on_signal, signal_name="PropertiesChanged",
+                            dbus_interface=DBUS_PROP_IFACE, path="/benchmark/char0")
+    wall, cpu = run_throughput(
+            lambda: emitter.PropertiesChanged(GATT_CHRC_IFACE, {"Value": dbus.ByteArray(payload)}, []),
+            args.duration)
+    results["signal"] = throughput_result(received[0], wall, cpu)
+
+    local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    local.setblocking(False)
+    remote.setblocking(False)
+    received[0] = 0
+
+    def send():
+        try:
+            local.send(payload)
+        except BlockingIOError:
+            pass
+
+    def readable(fd, condition):
+        try:
+            while True:
+                received[0] += len(remote.recv(len(payload)))
+        except BlockingIOError:
+            pass
+        return True
+
+    watch = GObject.io_add_watch(remote.fileno(), GObject.IO_IN, readable)
+    wall, cpu = run_throughput(send, args.duration)
+    GObject.source_remove(watch)
+    local.close()
+    remote.close()
+    results["acquired"] = throughput_result(received[0], wall, cpu)
+    return results
+
+
+class GattHarness(object):
+    """
+    Runs the VPS service against mocks.py on a private dbus-daemon, with the
+    Blyqt API served by StubBlyqtHandler and mock hciconfig/nmcli commands.
+    Acts as BlueZ towards the registered application, calling its
+    characteristics on behalf of simulated centrals.
+    """
+    def __init__(self):
+        self.tmp = tempfile.mkdtemp(prefix="vps-bench-")
+        self.processes = []
+        self.service = None
+        self.server = None
+
+    def start(self):
+        import dbus
+        import dbus.mainloop.glib
+
+        daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+                                  stdout=subprocess.PIPE, text=True)
+        self.processes.append(daemon)
+        self.address = daemon.stdout.readline().strip()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubBlyqtHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        bin_dir = os.path.join(self.tmp, "bin")
+        os.mkdir(bin_dir)
+        for name, script in MOCK_COMMANDS.items():
+            path = os.path.join(bin_dir, name)
+            with open(path, "w") as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+
+        self.env = dict(os.environ)
+        self.env.update({
+            "VPS_DBUS_ADDRESS": self.address,
+            "DBUS_SESSION_BUS_ADDRESS": self.address,
+            "BLYQT_API_PREFIX": "http://127.0.0.1:%d/api/v1" % self.server.server_address[1],
+            "PATH": bin_dir + os.pathsep + os.environ.get("PATH", ""),
+            "SETTINGS_PATH": os.path.join(self.tmp, "settings.json"),
+            "METRICS_TEXTFILE": os.path.join(self.tmp, "vps_ble.prom"),
+            "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+        })
+
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self.bus = dbus.bus.BusConnection(self.address)
+        self.processes.append(self.spawn("mocks.py"))
+        self.wait_for(lambda: self.bus.name_has_owner("org.bluez"))
+        self.mock = self.bus.get_object("org.bluez", "/", introspect=False)
+
+    def spawn(self, script):
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.Popen([sys.executable, os.path.join(here, script)],
+                                env=self.env, cwd=here)
+
+    def wait_for(self, condition, timeout=STARTUP_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise RuntimeError("Timed out waiting for the service under test")
+            time.sleep(0.01)
+
+    def start_service(self):
+        """
+        Starts main.py and returns the milliseconds until both the GATT
+        application and the advertisement are registered.
+        """
+        self.stop_service()
+        self.mock.Reset(dbus_interface="io.vpsrecorder.Mock1")
+        start = time.time()
+        self.service = self.spawn("main.py")
+
+        def registered():
+            events = self.mock.GetEvents(dbus_interface="io.vpsrecorder.Mock1")
+            return "RegisterApplication" in events and "RegisterAdvertisement" in events
+
+        self.wait_for(registered)
+        events = self.mock.GetEvents(dbus_interface="io.vpsrecorder.Mock1")
+        self.application = str(self.mock.GetApplication(dbus_interface="io.vpsrecorder.Mock1"))
+        return {name: (float(at) - start) * 1000.0 for name, at in events.items()}
+
+    def stop_service(self):
+        if self.service is not None:
+            self.service.terminate()
+            self.service.wait()
+            self.service = None
+
+    def characteristics(self):
+        objects = self.bus.get_object(self.application, "/", introspect=False).GetManagedObjects(
+                dbus_interface=DBUS_OM_IFACE)
+        return {str(interfaces[GATT_CHRC_IFACE]["UUID"]): str(path)
+                for path, interfaces in objects.items() if GATT_CHRC_IFACE in interfaces}
+
+    def characteristic(self, uuid):
+        return self.bus.get_object(self.application, self.characteristics()[uuid],
+                                   introspect=False)
+
+    def stop(self):
+        self.stop_service()
+        for process in reversed(self.processes):
+            process.terminate()
+            process.wait()
+        if self.server is not None:
+            self.server.shutdown()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def central_options(index):
+    import dbus
+    return dbus.Dictionary({
+        "device": dbus.ObjectPath("/org/bluez/hci0/dev_00_00_00_00_00_%02X" % index),
+        "mtu": dbus.UInt16(GATT_MTU),
+    }, signature="sv")
+
+
+def run_centrals(calls, duration):
+    """
+    Keeps one call in flight per simulated central for `duration` seconds.
+    Each entry of `calls` is call(reply_handler, error_handler).
+    """
+    loop = GObject.MainLoop()
+    samples = []
+    state = {"errors": 0, "in_flight": 0}
+    deadline = time.monotonic() + duration
+
+    def issue(call):
+        start = time.monotonic()
+        state["in_flight"] += 1
+
+        def on_reply(*args):
+            samples.append((time.monotonic() - start) * 1000.0)
+            done(call)
+
+        def on_error(error):
+            state["errors"] += 1
+            done(call)
+
+        call(on_reply, on_error)
+
+    def done(call):
+        state["in_flight"] -= 1
+        if time.monotonic() < deadline:
+            issue(call)
+        elif state["in_flight"] == 0:
+            loop.quit()
+
+    for call in calls:
+        issue(call)
+    GObject.timeout_add(int((duration + STARTUP_TIMEOUT) * 1000), loop.quit)
+    loop.run()
+    result = summarize(samples)
+    result["ops_per_s"] = len(samples) / duration
+    result["errors"] = state["errors"]
+    return result
+
+
+def count_notifications(subscribe, unsubscribe, calls, duration):
+    """
+    Runs `calls` like run_centrals() while counting the notification bytes
+    delivered to the callback registered by subscribe(on_value).
+    """
+    received = {"bytes": 0, "count": 0}
+
+    def on_value(value):
+        received["bytes"] += len(value)
+        received["count"] += 1
+
+    subscription = subscribe(on_value)
+    start = time.monotonic()
+    result = run_centrals(calls, duration)
+    elapsed = time.monotonic() - start
+    unsubscribe(subscription)
+    result["notifications"] = received["count"]
+    result["notify_bytes_per_s"] = received["bytes"] / elapsed
+    return result
+
+
+def bench_gatt(args):
+    """
+    Starts the service `args.repeat` times against the mock BlueZ to time
+    startup, then measures read, write and notify handling under
+    `args.centrals` concurrent simulated centrals.
+    """
+    import dbus
+    from main import (DEVICE_STATUS_CHARACTERISTIC_UUID, LOCALNAME_CHARACTERISTIC_UUID,
+                      REMOTE_CONTROL_CHARACTERISTIC_UUID, TERMINAL_CHARACTERISTIC_UUID)
+    from protocol import encode_message, FIELD_OPCODE, FIELD_SEQUENCE, OPCODE_START_RECORDING
+
+    harness = GattHarness()
+    results = {}
+    try:
+        harness.start()
+        startups = [harness.start_service() for _ in range(args.repeat)]
+        results["startup"] = {name: summarize([run[name] for run in startups])
+                              for name in ("RegisterApplication", "RegisterAdvertisement")}
+
+        centrals = range(args.centrals)
+
+        def reads(uuid):
+            chrc = harness.characteristic(uuid)
+            return [lambda reply, error, i=i: chrc.ReadValue(
+                            central_options(i), dbus_interface=GATT_CHRC_IFACE,
+                            byte_arrays=True, reply_handler=reply, error_handler=error)
+                    for i in centrals]
+
+        results["read-cached"] = run_centrals(reads(LOCALNAME_CHARACTERISTIC_UUID), args.duration)
+        results["read-status"] = run_centrals(reads(DEVICE_STATUS_CHARACTERISTIC_UUID), args.duration)
+
+        remote = harness.characteristic(REMOTE_CONTROL_CHARACTERISTIC_UUID)
+        writes = [lambda reply, error, i=i: remote.WriteValue(
+                          dbus.ByteArray(encode_message({FIELD_OPCODE: OPCODE_START_RECORDING,
+                                                         FIELD_SEQUENCE: i})),
+                          central_options(i), dbus_interface=GATT_CHRC_IFACE,
+                          reply_handler=reply, error_handler=error)
+                  for i in centrals]
+        results["write-command"] = run_centrals(writes, args.duration)
+
+        terminal_path = harness.characteristics()[TERMINAL_CHARACTERISTIC_UUID]
+        terminal = harness.characteristic(TERMINAL_CHARACTERISTIC_UUID)
+        commands = [lambda reply, error, i=i: terminal.WriteValue(
+                            dbus.ByteArray(TERMINAL_COMMAND.encode()), central_options(i),
+                            dbus_interface=GATT_CHRC_IFACE,
+                            reply_handler=reply, error_handler=error)
+                    for i in centrals]
+
+        def subscribe_signal(on_value):
+            def on_changed(interface, changed, invalidated):
+                if "Value" in changed:
+                    on_value(changed["Value"])
+
+            match = harness.bus.add_signal_receiver(on_changed, signal_name="PropertiesChanged",
+                    dbus_interface=DBUS_PROP_IFACE, bus_name=harness.application,
+                    path=terminal_path, byte_arrays=True)
+            terminal.StartNotify(dbus_interface=GATT_CHRC_IFACE)
+            return match
+
+        def unsubscribe_signal(match):
+            terminal.StopNotify(dbus_interface=GATT_CHRC_IFACE)
+            match.remove()
+
+        def subscribe_acquired(on_value):
+            fd, mtu = terminal.AcquireNotify(central_options(0), dbus_interface=GATT_CHRC_IFACE)
+            sock = socket.socket(fileno=fd.take())
+            sock.setblocking(False)
+
+            def readable(source, condition):
+                try:
+                    while True:
+                        value = sock.recv(int(mtu))
+                        if not value:
+                            return False
+                        on_value(value)
+                except BlockingIOError:
+                    return True
+
+            return sock, GObject.io_add_watch(sock.fileno(), GObject.IO_IN, readable)
+
+        def unsubscribe_acquired(subscription):
+            sock, watch = subscription
+            GObject.source_remove(watch)
+            sock.close()
+
+        results["notify-signal"] = count_notifications(subscribe_signal, unsubscribe_signal,
+                                                       commands, args.duration)
+        results["notify-acquired"] = count_notifications(subscribe_acquired, unsubscribe_acquired,
+                                                         commands, args.duration)
+    finally:
+        harness.stop()
+    return results
+
+
+def bench_provisioning(args):
+    """
+    Checks the Wi-Fi provisioning flow against the mock NetworkManager. Each
+    of `args.repeat` connect requests must reach connected, and the states
+    notified on the Wi-Fi status characteristic must follow queued,
+    associating, dhcp, connected. Coalesced notifications may skip a state.
+    """
+    import dbus
+    from main import WIFI_CONFIG_CHARACTERISTIC_UUID, WIFI_STATUS_CHARACTERISTIC_UUID
+    from protocol import (encode_message, decode_message, FIELD_SSID, FIELD_PASSWORD,
+                          FIELD_WIFI_STATE, FIELD_REASON, WIFI_STATE_CODES)
+
+    state_names = {code: name for name, code in WIFI_STATE_CODES.items()}
+    harness = GattHarness()
+    samples = []
+    try:
+        harness.start()
+        harness.start_service()
+        status_path = harness.characteristics()[WIFI_STATUS_CHARACTERISTIC_UUID]
+        status = harness.characteristic(WIFI_STATUS_CHARACTERISTIC_UUID)
+        config = harness.characteristic(WIFI_CONFIG_CHARACTERISTIC_UUID)
+        loop = GObject.MainLoop()
+        states = []
+
+        def on_changed(interface, changed, invalidated):
+            if "Value" not in changed:
+                return
+            fields = decode_message(changed["Value"])
+            states.append((state_names[fields[FIELD_WIFI_STATE]], fields[FIELD_REASON]))
+            if states[-1][0] in ("connected", "failed"):
+                loop.quit()
+
+        match = harness.bus.add_signal_receiver(on_changed, signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROP_IFACE, bus_name=harness.application,
+                path=status_path, byte_arrays=True)
+        status.StartNotify(dbus_interface=GATT_CHRC_IFACE)
+        request = dbus.ByteArray(encode_message({FIELD_SSID: PROVISIONING_SSID,
+                                                 FIELD_PASSWORD: PROVISIONING_PASSWORD}))
+        for _ in range(args.repeat):
+            del states[:]
+            start = time.monotonic()
+            config.WriteValue(request, central_options(0), dbus_interface=GATT_CHRC_IFACE)
+            timer = GObject.timeout_add(int(STARTUP_TIMEOUT * 1000), loop.quit)
+            loop.run()
+            names = [name for name, reason in states]
+            if not names or names[-1] != "connected":
+                raise RuntimeError(f"Provisioning did not connect: {states}")
+            GObject.source_remove(timer)
+            samples.append((time.monotonic() - start) * 1000.0)
+            order = [PROVISIONING_STATES.index(name) for name in names]
+            if order != sorted(order):
+                raise RuntimeError(f"Provisioning states out of order: {states}")
+        status.StopNotify(dbus_interface=GATT_CHRC_IFACE)
+        match.remove()
+    finally:
+        harness.stop()
+    result = summarize(samples)
+    result["states"] = names
+    return result
+
+
+BENCHMARKS = {
+    "loop-latency": bench_loop_latency,
+    "startup": bench_startup,
+    "http": bench_http,
+    "throughput": bench_throughput,
+    "gatt": bench_gatt,
+    "provisioning": bench_provisioning,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VPS BLE service benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--command", default="sleep 1",
+                        help="slow command run by the simulated write handler")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="seconds to sample for")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of runs for repeated benchmarks")
+    parser.add_argument("--payload", type=int, default=244,
+                        help="notification payload size in bytes")
+    parser.add_argument("--centrals", type=int, default=4,
+                        help="number of simulated centrals for the gatt benchmark")
+    args = parser.parse_args()
+    print(json.dumps({args.benchmark: BENCHMARKS[args.benchmark](args)}, indent=2))
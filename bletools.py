@@ -19,6 +19,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import os
+import time
 import dbus
 try:
   from gi.repository import GObject
@@ -28,30 +30,128 @@ except ImportError:
 BLUEZ_SERVICE_NAME = "org.bluez"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+ADAPTER_READY_TIMEOUT = 5.0
+# Bus address used instead of the system bus, e.g. a private benchmark bus
+DBUS_ADDRESS_ENV = "VPS_DBUS_ADDRESS"
 
 class BleTools(object):
+    """
+    Process-wide D-Bus connection and BlueZ adapter registry. The adapter list
+    is fetched with a single GetManagedObjects call and then kept current from
+    the BlueZ InterfacesAdded/InterfacesRemoved signals.
+    """
+    bus = None
+    adapters = None
+    adapter_name = None
+
     @classmethod
     def get_bus(self):
-         bus = dbus.SystemBus()
+        if self.bus is None:
+            address = os.environ.get(DBUS_ADDRESS_ENV)
+            if address:
+                self.bus = dbus.bus.BusConnection(address)
+            else:
+                self.bus = dbus.SystemBus()
+
+        return self.bus
 
-         return bus
+    @classmethod
+    def select_adapter(self, name):
+        self.adapter_name = name
 
     @classmethod
-    def find_adapter(self, bus):
-        remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"),
-                               DBUS_OM_IFACE)
-        objects = remote_om.GetManagedObjects()
+    def get_adapters(self, bus=None):
+        if self.adapters is None:
+            bus = bus or self.get_bus()
+            bus.add_signal_receiver(self.interfaces_added,
+                    dbus_interface=DBUS_OM_IFACE,
+                    signal_name="InterfacesAdded",
+                    bus_name=BLUEZ_SERVICE_NAME)
+            bus.add_signal_receiver(self.interfaces_removed,
+                    dbus_interface=DBUS_OM_IFACE,
+                    signal_name="InterfacesRemoved",
+                    bus_name=BLUEZ_SERVICE_NAME)
+
+            remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"),
+                                   DBUS_OM_IFACE)
+            objects = remote_om.GetManagedObjects()
 
-        for o, props in objects.items():
-            if LE_ADVERTISING_MANAGER_IFACE in props:
+            self.adapters = {}
+            for o, props in objects.items():
+                self.interfaces_added(o, props)
+
+        return sorted(self.adapters)
+
+    @classmethod
+    def find_adapter(self, bus=None, name=None):
+        name = name or self.adapter_name
+        for o in self.get_adapters(bus):
+            if name is None or o.rsplit("/", 1)[-1] == name:
                 return o
 
         return None
 
     @classmethod
-    def power_adapter(self):
-        adapter = self.get_adapter()
+    def interfaces_added(self, path, interfaces):
+        if LE_ADVERTISING_MANAGER_IFACE in interfaces:
+            self.adapters[str(path)] = set(interfaces)
+
+    @classmethod
+    def interfaces_removed(self, path, interfaces):
+        if LE_ADVERTISING_MANAGER_IFACE in interfaces:
+            self.adapters.pop(str(path), None)
+
+    @classmethod
+    def power_adapter(self, bus, adapter, timeout=ADAPTER_READY_TIMEOUT):
+        powered = self.set_adapter_property(bus, adapter, "Powered",
+                                            dbus.Boolean(1), timeout)
+        if powered is None:
+            return False
+        self.set_adapter_property(bus, adapter, "DiscoverableTimeout",
+                                  dbus.UInt32(0), timeout)
+        discoverable = self.set_adapter_property(bus, adapter, "Discoverable",
+                                                 dbus.Boolean(1), timeout)
+        return discoverable is not None
 
+    @classmethod
+    def set_adapter_property(self, bus, adapter, name, value, timeout=ADAPTER_READY_TIMEOUT):
+        """
+        Sets an org.bluez.Adapter1 property and waits until BlueZ reports the
+        new value, returning the elapsed seconds or None on timeout.
+        """
+        start = time.monotonic()
         adapter_props = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, adapter),
-                "org.freedesktop.DBus.Properties");
-        adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
+                DBUS_PROP_IFACE)
+        loop = GObject.MainLoop()
+        state = {"ready": False}
+
+        def properties_changed(interface, changed, invalidated):
+            if interface == ADAPTER_IFACE and changed.get(name) == value:
+                state["ready"] = True
+                loop.quit()
+
+        def expired():
+            loop.quit()
+            return False
+
+        match = bus.add_signal_receiver(properties_changed,
+                dbus_interface=DBUS_PROP_IFACE,
+                signal_name="PropertiesChanged",
+                path=adapter)
+        try:
+            adapter_props.Set(ADAPTER_IFACE, name, value)
+            if adapter_props.Get(ADAPTER_IFACE, name) == value:
+                state["ready"] = True
+            if not state["ready"]:
+                timeout_id = GObject.timeout_add(int(timeout * 1000), expired)
+                loop.run()
+                if state["ready"]:
+                    GObject.source_remove(timeout_id)
+        finally:
+            match.remove()
+
+        if not state["ready"]:
+            return None
+        return time.monotonic() - start
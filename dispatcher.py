@@ -0,0 +1,118 @@
+import collections
+import json
+import logging
+
+import api
+from executor import executor
+from protocol import (OPCODE_START_RECORDING, OPCODE_STOP_RECORDING, OPCODE_START_FRONT_LIVE,
+                      OPCODE_STOP_FRONT_LIVE, OPCODE_START_EYE_LIVE, OPCODE_STOP_EYE_LIVE,
+                      OPCODE_UPDATE_RECORDING_SETTINGS, OPCODE_UPDATE_MISCELLANEOUS_SETTINGS,
+                      RESULT_OK, RESULT_FAILED, RESULT_INVALID, RESULT_UNKNOWN_OPCODE)
+
+logger = logging.getLogger(__name__)
+
+# opcode: (api call, whether it takes the JSON payload as its argument)
+COMMANDS = {
+    OPCODE_START_RECORDING: (api.blyqt_start_recording, False),
+    OPCODE_STOP_RECORDING: (api.blyqt_stop_recording, False),
+    OPCODE_START_FRONT_LIVE: (api.blyqt_start_front_live, False),
+    OPCODE_STOP_FRONT_LIVE: (api.blyqt_stop_front_live, False),
+    OPCODE_START_EYE_LIVE: (api.blyqt_start_eye_live, False),
+    OPCODE_STOP_EYE_LIVE: (api.blyqt_stop_eye_live, False),
+    OPCODE_UPDATE_RECORDING_SETTINGS: (api.update_blyqt_recording_settings, True),
+    OPCODE_UPDATE_MISCELLANEOUS_SETTINGS: (api.update_blyqt_miscellaneous_settings, True),
+}
+
+# opcode: settings section handed to the SettingsManager instead
+SETTINGS_OPCODES = {
+    OPCODE_UPDATE_RECORDING_SETTINGS: "recording",
+    OPCODE_UPDATE_MISCELLANEOUS_SETTINGS: "hmi",
+}
+
+
+class Command(object):
+    __slots__ = ("opcode", "payload", "sequences")
+
+    def __init__(self, opcode, payload, sequence):
+        self.opcode = opcode
+        self.payload = payload
+        self.sequences = [sequence]
+
+    def matches(self, opcode, payload):
+        return self.opcode == opcode and self.payload == payload
+
+
+class CommandDispatcher(object):
+    """
+    Runs recorder API commands one at a time on the shared executor. A command
+    identical to the last queued one is coalesced into it; merging further back
+    or into the running command would reorder it past later commands. Every
+    submitted sequence number is acknowledged through `ack_callback(opcode,
+    sequence, result)` on the GLib loop. Settings updates go through `settings`
+    when one is given, so they are batched and diffed there.
+    """
+    def __init__(self, ack_callback, commands=COMMANDS, settings=None):
+        self.ack_callback = ack_callback
+        self.commands = commands
+        self.settings = settings
+        self.queue = collections.deque()
+        self.running = None
+
+    def submit(self, opcode, payload=b"", sequence=None):
+        if opcode not in self.commands:
+            logger.error(f"Unknown remote control opcode: {opcode}")
+            self.ack_callback(opcode, sequence, RESULT_UNKNOWN_OPCODE)
+            return
+
+        payload = bytes(payload)
+        if self.settings is not None and opcode in SETTINGS_OPCODES:
+            self.submit_settings(opcode, payload, sequence)
+            return
+
+        if self.queue and self.queue[-1].matches(opcode, payload):
+            logger.debug(f"Coalescing duplicate command {opcode:#04x}")
+            self.queue[-1].sequences.append(sequence)
+            return
+
+        self.queue.append(Command(opcode, payload, sequence))
+        self.run_next()
+
+    def submit_settings(self, opcode, payload, sequence):
+        section = SETTINGS_OPCODES[opcode]
+        try:
+            settings_json = json.loads(payload)
+            self.settings.update({section: settings_json[section]},
+                    lambda ok: self.ack_callback(opcode, sequence, RESULT_OK if ok else RESULT_FAILED))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Invalid payload for command {opcode:#04x}: {e!r}")
+            self.ack_callback(opcode, sequence, RESULT_INVALID)
+
+    def run_next(self):
+        if self.running is not None or not self.queue:
+            return
+        self.running = self.queue.popleft()
+        executor.submit(self.execute, self.running,
+                        callback=self.finished, error_callback=self.failed)
+
+    def execute(self, command):
+        func, takes_payload = self.commands[command.opcode]
+        if takes_payload:
+            return func(json.loads(command.payload))
+        return func()
+
+    def finished(self, ok):
+        self.complete(RESULT_OK if ok else RESULT_FAILED)
+
+    def failed(self, error):
+        if isinstance(error, (ValueError, KeyError, TypeError)):
+            logger.error(f"Invalid payload for command {self.running.opcode:#04x}: {error!r}")
+            self.complete(RESULT_INVALID)
+        else:
+            logger.error(f"Command {self.running.opcode:#04x} failed: {error!r}")
+            self.complete(RESULT_FAILED)
+
+    def complete(self, result):
+        command, self.running = self.running, None
+        for sequence in command.sequences:
+            self.ack_callback(command.opcode, sequence, result)
+        self.run_next()
@@ -0,0 +1,154 @@
+import logging
+import os
+import signal
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 2
+STREAM_READ_SIZE = 4096
+REAP_INTERVAL_MS = 100
+
+
+class CommandExecutor(object):
+    """
+    Runs blocking work on a small worker pool and hands the result back to
+    the GLib main loop, so D-Bus handlers never wait on a child process.
+    """
+    def __init__(self, max_workers=MAX_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix="executor")
+
+    def submit(self, func, *args, callback=None, error_callback=None):
+        future = self.pool.submit(func, *args)
+        if callback or error_callback:
+            future.add_done_callback(
+                lambda f: GObject.idle_add(self._deliver, f, callback, error_callback))
+        return future
+
+    def run_command(self, command, callback=None, error_callback=None,
+                    shell=True, timeout=None):
+        return self.submit(run_command_sync, command, shell, timeout,
+                           callback=callback, error_callback=error_callback)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False)
+
+    def _deliver(self, future, callback, error_callback):
+        error = future.exception()
+        if error is not None:
+            if error_callback:
+                error_callback(error)
+            else:
+                logger.error(f"Background task failed: {error!r}")
+        elif callback:
+            callback(future.result())
+        return False
+
+
+def run_command_sync(command, shell=True, timeout=None):
+    result = subprocess.run(command, shell=shell, capture_output=True,
+                            universal_newlines=True, timeout=timeout)
+    return result.returncode == 0, result.stdout, result.stderr
+
+
+class StreamingCommand(object):
+    """
+    A child process whose combined stdout and stderr is read from a
+    non-blocking pipe on the GLib loop. The process runs in its own process
+    group, so kill() also ends anything a shell command started. pause()
+    stops reading, so a slow consumer holds the process on a full pipe
+    instead of buffering its output. `callback` gets True once the process
+    has exited with status 0, False otherwise.
+    """
+    def __init__(self, command, output_callback, callback=None, shell=True, timeout=None):
+        self.command = command
+        self.output_callback = output_callback
+        self.callback = callback
+        self.process = subprocess.Popen(command, shell=shell, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        self.done = False
+        self.killed = False
+        self.paused = False
+        os.set_blocking(self.process.stdout.fileno(), False)
+        self.watch = None
+        self.watch_output()
+        self.timer = None
+        if timeout:
+            self.timer = GObject.timeout_add(int(timeout * 1000), self.expired)
+
+    def watch_output(self):
+        self.watch = GObject.io_add_watch(self.process.stdout.fileno(),
+                                          GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR,
+                                          self.readable)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        if self.watch is None and not self.process.stdout.closed:
+            self.watch_output()
+
+    def readable(self, fd, condition):
+        while True:
+            if self.paused:
+                self.watch = None
+                return False
+            try:
+                data = os.read(fd, STREAM_READ_SIZE)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                logger.error(f"Reading output of {self.command} failed: {e!r}")
+                data = b""
+            if not data:
+                self.watch = None
+                self.process.stdout.close()
+                self.reap()
+                return False
+            if not self.killed:
+                self.output_callback(data)
+
+    def reap(self):
+        returncode = self.process.poll()
+        if returncode is None:
+            # stdout is closed but the process has not exited yet
+            GObject.timeout_add(REAP_INTERVAL_MS, self.reap)
+            return False
+        self.finish(returncode == 0)
+        return False
+
+    def expired(self):
+        self.timer = None
+        logger.warning(f"{self.command} timed out, killing it")
+        self.kill()
+        return False
+
+    def kill(self):
+        if self.done:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        # discard what is left in the pipe, so the exit is still seen
+        self.killed = True
+        self.resume()
+
+    def finish(self, ok):
+        if self.timer is not None:
+            GObject.source_remove(self.timer)
+            self.timer = None
+        self.done = True
+        if self.callback:
+            self.callback(ok)
+
+
+executor = CommandExecutor()
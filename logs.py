@@ -0,0 +1,62 @@
+import atexit
+import collections
+import logging
+import logging.handlers
+import queue
+
+RING_BUFFER_CAPACITY = 500
+TAIL_FORMAT = "%(asctime)s %(levelname).1s %(name)s: %(message)s"
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records without formatting them. The listener runs in this
+    process, so the message is only built if a handler actually emits it.
+    """
+    def prepare(self, record):
+        return record
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last `capacity` records in memory. Records are stored as they
+    are and only formatted when tail() is called.
+    """
+    def __init__(self, capacity=RING_BUFFER_CAPACITY):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+        self.setFormatter(logging.Formatter(TAIL_FORMAT))
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def tail(self, count):
+        records = list(self.records)[-count:] if count > 0 else []
+        lines = []
+        for record in records:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                lines.append(f"{record.levelname} {record.name}: {record.msg!r}")
+        return "\n".join(lines)
+
+
+ring_buffer = RingBufferHandler()
+
+
+def setup_logging(level, handler, capacity=RING_BUFFER_CAPACITY):
+    """
+    Routes all logging through a queue, so callers on the GLib loop never
+    wait on stderr or journald. A listener thread passes records to
+    `handler` and to the ring buffer.
+    """
+    ring_buffer.records = collections.deque(ring_buffer.records, maxlen=capacity)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler, ring_buffer,
+                                              respect_handler_level=True)
+    root = logging.getLogger()
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -1,22 +1,43 @@
 #!/usr/bin/python3
-import re
 import dbus
-import colorlog
+import dbus.service
 import logging
 import os
-from subprocess import check_output, run
 import socket
 import time
-from threading import Timer
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
 
 from advertisement import Advertisement
-from service import Application, Service, Characteristic
-from api import blyqt_start_recording, blyqt_stop_recording
+from battery import BatteryMonitor, BATTERY_CACHE_TTL
+from netstate import NetworkState
+from wifi import WifiManager
+from provisioning import WifiProvisioner
+from wifiscan import WifiScanner
+from service import Application, Service, Characteristic, InvalidArgsException, FailedException
+from bletools import BleTools
+from executor import executor, StreamingCommand
+from protocol import (ChunkFramer, encode_access_point_removed, MAX_ATTRIBUTE_SIZE, AP_RECORD,
+                      encode_message, decode_message, is_message, ProtocolError,
+                      FIELD_BATTERY, FIELD_RECORDING, FIELD_STORAGE_FREE, FIELD_TEMPERATURE,
+                      FIELD_ERRORS, FIELD_WIFI_STATE, FIELD_REASON, FIELD_SSID,
+                      FIELD_PASSWORD, FIELD_OPCODE, FIELD_PAYLOAD, FIELD_SEQUENCE, FIELD_RESULT,
+                      OPCODE_START_RECORDING, OPCODE_STOP_RECORDING, RESULT_OK, RESULT_FAILED,
+                      ERROR_BATTERY_UNAVAILABLE, ERROR_RECORDER_API, ERROR_STORAGE_LOW,
+                      WIFI_STATE_CODES, encode_status_advertisement)
+from dispatcher import CommandDispatcher
+from settings import SettingsManager, SETTINGS_PATH
+from metrics import metrics, TEXTFILE_PATH
+import logs
 
 logger = logging.getLogger(__name__)
 
 
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+HOSTNAME_OBJECT_PATH = "/org/freedesktop/hostname1"
 VPS_SERVICE_UUID = "00001000-710e-4a5b-8d75-3e5b444bc3cf"
 
 CSSID_CHARACTERISTIC_UUID = "00002001-710e-4a5b-8d75-3e5b444bc3cf"
@@ -26,247 +47,726 @@ TERMINAL_CHARACTERISTIC_UUID = "00002004-710e-4a5b-8d75-3e5b444bc3cf"
 LOCALNAME_CHARACTERISTIC_UUID = "00002005-710e-4a5b-8d75-3e5b444bc3cf"
 REMOTE_CONTROL_CHARACTERISTIC_UUID = "00002006-710e-4a5b-8d75-3e5b444bc3cf"
 DEVICE_STATUS_CHARACTERISTIC_UUID = "00002007-710e-4a5b-8d75-3e5b444bc3cf"
+WIFI_STATUS_CHARACTERISTIC_UUID = "00002008-710e-4a5b-8d75-3e5b444bc3cf"
+WIFI_SCAN_CHARACTERISTIC_UUID = "00002009-710e-4a5b-8d75-3e5b444bc3cf"
+METRICS_CHARACTERISTIC_UUID = "0000200a-710e-4a5b-8d75-3e5b444bc3cf"
+LOG_TAIL_CHARACTERISTIC_UUID = "0000200b-710e-4a5b-8d75-3e5b444bc3cf"
+
+STATUS_SAMPLE_INTERVAL_MS = 2000
+STORAGE_PATH = "/"
+STORAGE_LOW_MIB = 1024
+THERMAL_ZONE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+LEGACY_OPCODES = {"0": OPCODE_START_RECORDING, "1": OPCODE_START_RECORDING}
+RECORDING_STATES = {OPCODE_START_RECORDING: True, OPCODE_STOP_RECORDING: False}
+STATUS_MIN_NOTIFY_INTERVAL = 1.0
+ADV_MIN_UPDATE_INTERVAL = 1.0
+ADV_MIN_REREGISTER_INTERVAL = 10.0
+LOG_TAIL_DEFAULT_RECORDS = 50
+LOG_TAIL_MAX_SIZE = MAX_ATTRIBUTE_SIZE
+TERMINAL_COMMAND_TIMEOUT = 300
+TERMINAL_LOG_TAIL_SIZE = 128
 
 
 class VpsAdvertisement(Advertisement):
-    def __init__(self, index):
+    """
+    Advertises the device status in the VPS service data so scanners can show
+    battery, recording and error state without connecting. Updates are sent
+    at most every ADV_MIN_UPDATE_INTERVAL through PropertiesChanged, or with
+    ADV_REREGISTER set by re-registering at most every
+    ADV_MIN_REREGISTER_INTERVAL for BlueZ versions that ignore it.
+    """
+    def __init__(self, index, service):
         Advertisement.__init__(self, index, "peripheral")
         local_name = "VPS-" + socket.gethostname()
         self.add_local_name(local_name)
-        self.include_tx_power = True
+        # TX power is left out so the status service data fits in 31 bytes
+        self.include_tx_power = False
+        self.service = service
+        self.reregister_updates = bool(os.environ.get("ADV_REREGISTER"))
+        self.min_interval = ADV_MIN_REREGISTER_INTERVAL if self.reregister_updates \
+            else ADV_MIN_UPDATE_INTERVAL
+        self.pending_timer = None
+        self.last_update = 0.0
+        self.status = self.get_status_data()
+        self.add_service_data(VPS_SERVICE_UUID, self.status)
+        service.status_listeners.append(self.status_changed)
+        service.battery.add_listener(lambda level: self.status_changed())
+        service.wifi.add_listener(lambda ssid: self.status_changed())
+        self.trace = None
         logger.info(f"Starting BLE advertisement")
 
+    def register_ad_callback(self):
+        Advertisement.register_ad_callback(self)
+        if self.trace is not None:
+            self.trace.mark("discoverable")
+            self.trace = None
+
+    def get_status_data(self):
+        service = self.service
+        return encode_status_advertisement(service.battery.level, service.recording,
+                                           service.wifi.ssid is not None,
+                                           service.get_errors(get_storage_free()))
+
+    def status_changed(self):
+        if self.pending_timer is not None:
+            return
+        elapsed = time.monotonic() - self.last_update
+        if elapsed < self.min_interval:
+            delay_ms = int((self.min_interval - elapsed) * 1000)
+            self.pending_timer = GObject.timeout_add(delay_ms, self.update_status)
+            return
+        self.update_status()
+
+    def update_status(self):
+        self.pending_timer = None
+        status = self.get_status_data()
+        if status == self.status:
+            return False
+        self.status = status
+        self.last_update = time.monotonic()
+        if self.reregister_updates:
+            self.add_service_data(VPS_SERVICE_UUID, status)
+            self.reregister()
+        else:
+            self.update_service_data(VPS_SERVICE_UUID, status)
+        return False
+
 
 class VpsService(Service):
     def __init__(self, index):
         Service.__init__(self, index, VPS_SERVICE_UUID, True)
+        ttl = float(os.environ.get("BATTERY_CACHE_TTL", BATTERY_CACHE_TTL))
+        self.battery = BatteryMonitor(self.get_bus(), ttl)
+        # Probe the MCU now so the reply arrives while the adapter comes up
+        self.battery.get(lambda level: None)
+        self.network = NetworkState()
+        self.network.start()
+        nm_bus = dbus.SessionBus() if os.environ.get("NM_BUS") == "session" else self.get_bus()
+        self.wifi = WifiManager(nm_bus)
+        self.provisioner = WifiProvisioner(self.wifi)
+        self.scanner = WifiScanner(self.wifi)
+        self.wifi.start(self.scanner.start)
+        self.settings = SettingsManager(os.environ.get("SETTINGS_PATH", SETTINGS_PATH))
+        self.recording = False
+        self.errors = 0
+        self.status_listeners = []
         self.add_characteristic(WifiConnectCharacteristic(self))
+        self.add_characteristic(WifiStatusCharacteristic(self))
+        self.add_characteristic(WifiScanCharacteristic(self))
         self.add_characteristic(CurrentSSIDCharacteristic(self))
         self.add_characteristic(IPCharacteristic(self))
         self.add_characteristic(LocalNameCharacteristic(self))
         self.add_characteristic(TerminalCharacteristic(self))
         self.add_characteristic(RemoteControlCharacteristic(self))
-        self.add_characteristic(DeviceStatusCharacteristic(self))
+        device_status = DeviceStatusCharacteristic(self)
+        self.add_characteristic(device_status)
+        self.status_listeners.append(device_status.status_changed)
+        self.battery.add_listener(device_status.battery_changed)
+        self.add_characteristic(MetricsCharacteristic(self))
+        self.add_characteristic(LogTailCharacteristic(self))
+        metrics.start_textfile(os.environ.get("METRICS_TEXTFILE", TEXTFILE_PATH))
         logger.info(f"Adding characteristics to service")
 
+    def set_recording(self, recording):
+        if recording == self.recording:
+            return
+        self.recording = recording
+        self.status_changed()
+
+    def set_error(self, error, active):
+        errors = self.errors | error if active else self.errors & ~error
+        if errors == self.errors:
+            return
+        self.errors = errors
+        self.status_changed()
+
+    def status_changed(self):
+        for listener in self.status_listeners:
+            listener()
+
+    def get_errors(self, storage_free):
+        errors = self.errors
+        if self.battery.level is None:
+            errors |= ERROR_BATTERY_UNAVAILABLE
+        if storage_free < STORAGE_LOW_MIB:
+            errors |= ERROR_STORAGE_LOW
+        return errors
+
 
 class RemoteControlCharacteristic(Characteristic):
+    acquire_write = True
+
     def __init__(self, service):
-        Characteristic.__init__(self, REMOTE_CONTROL_CHARACTERISTIC_UUID, ["write"], service)
+        Characteristic.__init__(self, REMOTE_CONTROL_CHARACTERISTIC_UUID,
+                                ["write", "write-without-response", "notify"], service)
+        self.notifying = False
+        self.dispatcher = CommandDispatcher(self.command_finished, settings=self.service.settings)
 
     def WriteValue(self, value, options):
-        # received_value = "".join([chr(byte) for byte in value])  
-        received_value = bytearray(value).decode()
-        logger.debug("Debug: Value received: " + received_value)
-        if received_value == "0":
-            blyqt_start_recording()
-        elif received_value == "1":
-            blyqt_start_recording()
+        self.assemble_write(value, options, self.handle_write)
+
+    def handle_write(self, value, options):
+        if is_message(value):
+            try:
+                fields = decode_message(value)
+            except ProtocolError as e:
+                logger.error(f"Invalid remote control message: {e}")
+                raise InvalidArgsException()
+            if FIELD_OPCODE not in fields:
+                raise InvalidArgsException()
+            self.dispatcher.submit(fields[FIELD_OPCODE], fields.get(FIELD_PAYLOAD, b""),
+                                   fields.get(FIELD_SEQUENCE))
+        else:
+            received_value = value.decode()
+            logger.debug("Value received: %s", received_value)
+            if received_value in LEGACY_OPCODES:
+                self.dispatcher.submit(LEGACY_OPCODES[received_value])
 
         # TODO:
         # Calibration, reset to factory settings, ..
 
+    def command_finished(self, opcode, sequence, result):
+        if opcode in RECORDING_STATES:
+            self.service.set_error(ERROR_RECORDER_API, result == RESULT_FAILED)
+            if result == RESULT_OK:
+                self.service.set_recording(RECORDING_STATES[opcode])
+
+        if self.notifying:
+            ack = encode_message({
+                FIELD_OPCODE: opcode,
+                FIELD_SEQUENCE: sequence,
+                FIELD_RESULT: result,
+            })
+            self.notify(ack, coalesce=False)
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+        self.notifying = True
+
+    def StopNotify(self):
+        if not self.notifying:
+            return
+        self.notifying = False
+
 
 class DeviceStatusCharacteristic(Characteristic):
+    acquire_notify = True
+
     def __init__(self, service):
         Characteristic.__init__(self, DEVICE_STATUS_CHARACTERISTIC_UUID, ["read", "notify"], service)
         self.notifying = False
         self.batLvl = 1
+        self.sample_timer = None
+        self.pending_timer = None
+        self.last_value = None
+        self.last_notify = 0.0
+
+    def get_status_value(self):
+        storage_free = get_storage_free()
+        errors = self.service.get_errors(storage_free)
+        return encode_message({
+            FIELD_BATTERY: self.batLvl,
+            FIELD_RECORDING: int(self.service.recording),
+            FIELD_STORAGE_FREE: storage_free,
+            FIELD_TEMPERATURE: get_temperature(),
+            FIELD_ERRORS: errors,
+        })
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="ay",
+                         async_callbacks=("reply_handler", "error_handler"))
+    def ReadValue(self, options, reply_handler, error_handler):
+        def on_done(batLvl):
+            self.batLvl = batLvl
+            reply_handler(self.get_status_value())
+
+        self.service.battery.get(on_done, error_handler)
 
-    def ReadValue(self, options):
-        self.batLvl = get_batt_level()
-        status = "%s,Ready" % (self.batLvl)
-        return status.encode("utf-8")
-    
     def StartNotify(self):
         if self.notifying:
             return
         self.notifying = True
+        self.last_value = None
+        self.sample_status()
+        self.sample_timer = self.add_timeout(STATUS_SAMPLE_INTERVAL_MS, self.sample_status)
 
     def StopNotify(self):
         if not self.notifying:
             return
         self.notifying = False
+        if self.sample_timer is not None:
+            self.remove_timeout(self.sample_timer)
+            self.sample_timer = None
+        if self.pending_timer is not None:
+            self.remove_timeout(self.pending_timer)
+            self.pending_timer = None
+
+    def sample_status(self):
+        def on_done(batLvl):
+            self.battery_changed(batLvl)
+
+        def on_error(error):
+            logger.warning(f"Sampling device status failed: {error}")
+
+        self.service.battery.get(on_done, on_error)
+        return self.notifying
+
+    def battery_changed(self, batLvl):
+        self.batLvl = batLvl
+        self.status_changed()
+
+    def status_changed(self):
+        if not self.notifying or self.pending_timer is not None:
+            return
+        if self.get_status_value() == self.last_value:
+            return
+
+        elapsed = time.monotonic() - self.last_notify
+        if elapsed < STATUS_MIN_NOTIFY_INTERVAL:
+            delay_ms = int((STATUS_MIN_NOTIFY_INTERVAL - elapsed) * 1000)
+            self.pending_timer = self.add_timeout(delay_ms, self.send_status)
+            return
+        self.send_status()
+
+    def send_status(self):
+        self.pending_timer = None
+        value = self.get_status_value()
+        if self.notifying and value != self.last_value:
+            self.last_value = value
+            self.last_notify = time.monotonic()
+            self.notify(value)
+        return False
 
 
 class TerminalCharacteristic(Characteristic):
+    acquire_notify = True
+
     def __init__(self, service):
         Characteristic.__init__(
             self, TERMINAL_CHARACTERISTIC_UUID, ["notify", "write", "read"], service
         )
         self.notifying = False
-        self.output = "1"
-        self.update_timer = None  # Timer for periodic updates
 
     def ReadValue(self, options):
-        self.output += "1"
-        print("read terminal {self.output}")
-        return self.output.encode("utf-8")
+        offset = int(options.get("offset", 0))
+        output = self.get_session(options).values.get(self.path, b"")
+        return bytes(output[offset:])
 
     def WriteValue(self, value, options):
-        print(bytearray(value).decode())
+        """
+        Replies as soon as the command has started; output follows as
+        notifications. A command still running from the same device is
+        killed first, and any command is killed after
+        TERMINAL_COMMAND_TIMEOUT seconds or when the device disconnects.
+        """
         command = bytearray(value).decode()
-        self.output = check_output(command, shell=True, universal_newlines=True)
-        print(self.output)
-        if self.notifying:
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": self.output.encode("utf-8")}, [])
+        logger.debug("Terminal command: %s", command)
+        framer = ChunkFramer(self.notify_mtu)
+        session = self.get_session(options)
+        previous = session.commands.pop(self.path, None)
+        if previous is not None:
+            previous.kill()
+        output = session.values[self.path] = bytearray()
+
+        def send_frames(frames):
+            if self.notifying:
+                room = True
+                for frame in frames:
+                    room = self.notify(frame, coalesce=False)
+                if not room and not running.paused:
+                    # stop reading until the central has caught up
+                    running.pause()
+                    self.when_drained(running.resume)
+
+        def on_output(data):
+            # reads only ever see the last attribute's worth of output
+            output.extend(data)
+            del output[:-MAX_ATTRIBUTE_SIZE]
+            send_frames(framer.feed(data))
+
+        def on_done(ok):
+            if session.commands.get(self.path) is running:
+                del session.commands[self.path]
+            if not ok:
+                logger.error(f"Executing command: {command} failed, "
+                             f"last output: {bytes(output[-TERMINAL_LOG_TAIL_SIZE:])!r}")
+            send_frames([framer.finish()])
+
+        try:
+            running = StreamingCommand(command, on_output, on_done,
+                                       timeout=TERMINAL_COMMAND_TIMEOUT)
+        except OSError as e:
+            raise FailedException(f"Starting command failed: {e}")
+        session.commands[self.path] = running
 
     def StartNotify(self):
         if self.notifying:
             return
         self.notifying = True
-        # self.update_timer = Timer(1.0, self.periodic_update)
-        # self.update_timer.start()
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": "1"}, [])
-        self.add_timeout(1000, self.set_temperature_callback)
 
     def StopNotify(self):
         if not self.notifying:
             return
         self.notifying = False
-        # if self.update_timer:
-        #     self.update_timer.cancel()
-
-    # def periodic_update(self):
-    #     if self.notifying:
-    #         print("timer")
-    #         self.output += "1"
-    #         self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": self.output.encode("utf-8")}, [])
-    #         self.update_timer = Timer(1.0, self.periodic_update)
-    #         self.update_timer.start()
-
-    def set_temperature_callback(self):
+
+
+class WifiConnectCharacteristic(Characteristic):
+    def __init__(self, service):
+        self.notifying = False
+        Characteristic.__init__(self, WIFI_CONFIG_CHARACTERISTIC_UUID, ["write"], service)
+
+    def WriteValue(self, value, options):
+        self.assemble_write(value, options, self.handle_write)
+
+    def handle_write(self, value, options):
+        try:
+            if is_message(value):
+                fields = decode_message(value)
+                ssid = fields.get(FIELD_SSID, b"").decode("utf-8")
+                password = fields.get(FIELD_PASSWORD, b"").decode("utf-8")
+            else:
+                ssid, password = value.decode().split(",", 1)
+        except (ProtocolError, ValueError) as e:
+            # ValueError covers undecodable UTF-8 and a legacy write without a comma
+            logger.error(f"Invalid Wi-Fi connect message: {e}")
+            raise InvalidArgsException()
+        if not ssid:
+            logger.error("Wi-Fi connect message without an SSID")
+            raise InvalidArgsException()
+        # The password must not end up in the log tail characteristic
+        logger.debug("Wi-Fi connect request for %s", ssid)
+        self.service.provisioner.request(ssid, password)
+
+
+class WifiStatusCharacteristic(Characteristic):
+    def __init__(self, service):
+        Characteristic.__init__(self, WIFI_STATUS_CHARACTERISTIC_UUID, ["read", "notify"], service)
+        self.notifying = False
+        self.service.provisioner.add_listener(self.provisioning_changed)
+
+    def provisioning_changed(self, state, reason):
+        self.invalidate_value()
         if self.notifying:
-            print("trigger")
-            value = 1
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        return self.notifying
+            self.notify(self.read_cached_value())
 
-    # def StartNotify(self):
-    #     if self.notifying:
-    #         return
+    def get_value(self):
+        provisioner = self.service.provisioner
+        return encode_message({
+            FIELD_WIFI_STATE: WIFI_STATE_CODES[provisioner.state],
+            FIELD_REASON: provisioner.reason,
+        })
 
-    #     self.notifying = True
+    def ReadValue(self, options):
+        return self.read_cached_value()
 
-    #     value = self.get_temperature()
-    #     self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-    #     self.add_timeout(NOTIFY_TIMEOUT, self.set_temperature_callback)
+    def StartNotify(self):
+        if self.notifying:
+            return
+        self.notifying = True
 
-    # def StopNotify(self):
-    #     self.notifying = False
+    def StopNotify(self):
+        if not self.notifying:
+            return
+        self.notifying = False
 
 
-class WifiConnectCharacteristic(Characteristic):
+class WifiScanCharacteristic(Characteristic):
+    """
+    Access point records. Reads return as many whole records as fit in one
+    attribute value, taken per device at offset 0 so a long read is
+    consistent; notifications carry the full list as framed diffs.
+    """
     def __init__(self, service):
+        Characteristic.__init__(self, WIFI_SCAN_CHARACTERISTIC_UUID, ["read", "notify"], service)
         self.notifying = False
-        Characteristic.__init__(self, WIFI_CONFIG_CHARACTERISTIC_UUID, ["write"], service)
+        self.waiting = False
+        self.sent = {}
+        self.framer = ChunkFramer(self.notify_mtu)
+        self.service.scanner.add_listener(self.scan_changed)
 
-    def WriteValue(self, value, options):
-        received_value = bytearray(value).decode()
-        logger.debug("Debug: Value received: " + received_value)
-        ssid, password = received_value.split(",")
-        command = f"nmcli d wifi connect {ssid} password {password}"
-        ok, stdout, stderr = run_command(command)
-        if not ok:
-            logger.error(f"Executing command: {command} failed: {stdout=}, {stderr=}")
+    def ReadValue(self, options):
+        offset = int(options.get("offset", 0))
+        values = self.get_session(options).values
+        if offset == 0 or self.path not in values:
+            records = list(self.service.scanner.records.values())
+            values[self.path] = b"".join(records[:MAX_ATTRIBUTE_SIZE // AP_RECORD.size])
+        return values[self.path][offset:]
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+        self.notifying = True
+        self.sent = {}
+        self.framer = ChunkFramer(self.notify_mtu)
+        self.service.scanner.set_active(True)
+        self.scan_changed()
+
+    def StopNotify(self):
+        if not self.notifying:
+            return
+        self.notifying = False
+        self.service.scanner.set_active(False)
+
+    def scan_changed(self):
+        if not self.notifying or self.waiting:
+            return
+        records = self.service.scanner.records
+        diff = [record for ap_id, record in records.items() if self.sent.get(ap_id) != record]
+        diff += [encode_access_point_removed(ap_id) for ap_id in self.sent if ap_id not in records]
+        if not diff:
+            return
+        self.sent = dict(records)
+        room = True
+        for frame in self.framer.frame_message(b"".join(diff)):
+            room = self.notify(frame, coalesce=False)
+        if not room:
+            # later changes are diffed against self.sent once there is room
+            self.waiting = True
+            self.when_drained(self.drained)
+
+    def drained(self):
+        self.waiting = False
+        self.scan_changed()
 
 
 class CurrentSSIDCharacteristic(Characteristic):
     def __init__(self, service):
         Characteristic.__init__(self, CSSID_CHARACTERISTIC_UUID, ["read"], service)
+        self.service.wifi.add_listener(self.ssid_changed)
 
-    def ReadValue(self, options):
-        cssid = get_connected_ssid()
+    def ssid_changed(self, ssid):
+        self.invalidate_value()
+
+    def get_value(self):
+        cssid = self.service.wifi.ssid or "Not connected"
         return cssid.encode("utf-8")
+
+    def ReadValue(self, options):
+        return self.read_cached_value()
     
 
 class IPCharacteristic(Characteristic):
     def __init__(self, service):
-        Characteristic.__init__(self, IP_CHARACTERISTIC_UUID, ["read"], service)
+        Characteristic.__init__(self, IP_CHARACTERISTIC_UUID, ["read", "notify"], service)
+        self.notifying = False
+        self.service.network.add_listener(self.addresses_changed)
 
-    def ReadValue(self, options):
-        hostname = socket.gethostname()
-        ip_address = socket.gethostbyname(hostname)
+    def addresses_changed(self, interface):
+        previous = self.cached_value
+        self.invalidate_value()
+        if self.notifying and self.read_cached_value() != previous:
+            self.notify(self.cached_value)
+
+    def get_value(self):
+        ip_address = self.service.network.primary_address or ""
         return ip_address.encode("utf-8")
 
+    def ReadValue(self, options):
+        return self.read_cached_value()
+
+    def StartNotify(self):
+        if self.notifying:
+            return
+        self.notifying = True
+
+    def StopNotify(self):
+        if not self.notifying:
+            return
+        self.notifying = False
+
 
 class LocalNameCharacteristic(Characteristic):
     def __init__(self, service):
         Characteristic.__init__(self, LOCALNAME_CHARACTERISTIC_UUID, ["read"], service)
+        self.bus.add_signal_receiver(self.hostname_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROP_IFACE,
+                path=HOSTNAME_OBJECT_PATH)
 
-    def ReadValue(self, options):
+    def hostname_changed(self, interface, changed, invalidated):
+        if "Hostname" in changed or "Hostname" in invalidated:
+            self.invalidate_value()
+
+    def get_value(self):
         host_name = socket.gethostname()
         return host_name.encode("utf-8")
 
+    def ReadValue(self, options):
+        return self.read_cached_value()
 
-def run_command(command, timeout_sec=0.3):
-    result = run(command, shell=True, check=True)
-    time.sleep(timeout_sec)
-    return result.returncode == 0, result.stdout, result.stderr
 
+class MetricsCharacteristic(Characteristic):
+    """
+    Returns one page of the metrics snapshot. Writing a uint8 selects the
+    page this device reads; a long read continues from the page taken at
+    offset 0.
+    """
+    def __init__(self, service):
+        Characteristic.__init__(self, METRICS_CHARACTERISTIC_UUID, ["read", "write"], service)
+        self.page_key = self.path + "/page"
 
-def start_bluetooth():
-    initialization_commands = [
-        "hciconfig hci0 up",
-        "hciconfig hci0 piscan",
-        "hciconfig hci0 sspmode 1",
-    ]
-    init_done = True
-    for command in initialization_commands:
-        ok, stdout, stderr = run_command(command)
+    def WriteValue(self, value, options):
+        value = bytes(value)
+        if len(value) != 1:
+            raise InvalidArgsException()
+        self.get_session(options).values[self.page_key] = value[0]
+
+    def ReadValue(self, options):
+        offset = int(options.get("offset", 0))
+        values = self.get_session(options).values
+        if offset == 0 or self.path not in values:
+            values[self.path] = metrics.snapshot(values.get(self.page_key, 0))
+        return values[self.path][offset:]
+
+
+class LogTailCharacteristic(Characteristic):
+    """
+    Returns the most recent log records as text, cut to the whole lines
+    that fit in LOG_TAIL_MAX_SIZE bytes. Writing a little-endian uint16 sets
+    how many records this device gets; a long read continues from the tail
+    taken at offset 0.
+    """
+    def __init__(self, service):
+        Characteristic.__init__(self, LOG_TAIL_CHARACTERISTIC_UUID, ["read", "write"], service)
+        self.count_key = self.path + "/count"
+
+    def WriteValue(self, value, options):
+        value = bytes(value)
+        if len(value) != 2:
+            raise InvalidArgsException()
+        self.get_session(options).values[self.count_key] = int.from_bytes(value, "little")
+
+    def ReadValue(self, options):
+        offset = int(options.get("offset", 0))
+        values = self.get_session(options).values
+        if offset == 0 or self.path not in values:
+            count = values.get(self.count_key, LOG_TAIL_DEFAULT_RECORDS)
+            tail = logs.ring_buffer.tail(count).encode("utf-8")
+            if len(tail) > LOG_TAIL_MAX_SIZE:
+                tail = tail[-LOG_TAIL_MAX_SIZE:]
+                tail = tail[tail.find(b"\n") + 1:]
+            values[self.path] = tail
+        return values[self.path][offset:]
+
+
+class StartupTrace(object):
+    """
+    Logs how long each startup phase took, measured from process start so
+    interpreter startup and imports are included.
+    """
+    def __init__(self):
+        self.start = time.monotonic() - get_process_age()
+        self.last = self.start
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.monotonic()
+        self.phases.append((phase, (now - self.start) * 1000.0))
+        logger.info(f"Startup phase {phase}: {(now - self.last) * 1000:.1f} ms, "
+                    f"{(now - self.start) * 1000:.1f} ms since process start")
+        self.last = now
+
+
+def get_process_age():
+    try:
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+
+
+def start_bluetooth(bus):
+    """
+    Powers the adapter and makes it discoverable, returning once it is. SSP
+    is enabled in the background so advertising can start right away.
+    """
+    start = time.monotonic()
+    adapter = BleTools.find_adapter(bus)
+    if adapter is None:
+        logger.error("No BLE adapter found")
+        return False
+
+    if not BleTools.power_adapter(bus, adapter):
+        logger.error(f"Adapter {adapter} did not become powered and discoverable")
+        return False
+    logger.debug(f"Adapter {adapter} ready after {(time.monotonic() - start) * 1000:.1f} ms")
+
+    command = f"hciconfig {os.path.basename(adapter)} sspmode 1"
+
+    def on_done(result):
+        ok, stdout, stderr = result
         if not ok:
-            init_done = False
             logger.error(f"Executing command: {command} failed: {stdout=}, {stderr=}")
-    return init_done
+            return
+        logger.debug(f"Bluetooth started in {(time.monotonic() - start) * 1000:.1f} ms")
+
+    executor.run_command(command, callback=on_done,
+                         error_callback=lambda e: logger.error(f"Executing command: {command} failed: {e!r}"))
+    return True
+
+
+def get_storage_free(path=STORAGE_PATH):
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize // (1024 * 1024)
+
+
+def get_temperature():
+    try:
+        with open(THERMAL_ZONE_PATH) as f:
+            millidegrees = int(f.read())
+    except (OSError, ValueError):
+        return None
+    # Whole degrees, so sensor noise does not trigger notifications
+    return round(millidegrees / 1000.0) * 10
 
 
 def setup_logging(level):
-    logger = logging.getLogger()
+    import colorlog
+
     handler = colorlog.StreamHandler()
     handler.setFormatter(
         colorlog.ColoredFormatter(
             "(%(asctime)s) [%(log_color)s%(levelname)-7s] | %(name)s %(filename)s:%(lineno)d | %(message)s"
         )
     )
-    logger.addHandler(handler)
-    logger.setLevel(level)
-
-
-def get_connected_ssid():
-    output = check_output(["nmcli", "connection", "show", "--active"], universal_newlines=True)
-    lines = output.split('\n')
-    for line in lines:
-        if "wifi" in line:
-            return line.split()[0]
-    return "Not connected"
-
-
-def get_batt_level():
-    check_batt_status_command = "dbus-send --system --print-reply --dest=io.vpsrecorder.mcucom /io/vpsrecorder/mcucom io.vpsrecorder.mcucom.getBatterySOC boolean:true"
-    output = check_output(check_batt_status_command, shell=True, universal_newlines=True)
-    match = re.search(r'uint16 (\d+)', output)
-    return int(match.group(1))
+    logs.setup_logging(level, handler)
 
 
 if __name__ == "__main__":
+    trace = StartupTrace()
     LOG_LEVEL = "DEBUG" if not os.environ.get("LOG_LEVEL") else os.environ["LOG_LEVEL"]
     setup_logging(LOG_LEVEL)
+    if os.environ.get("BLE_ADAPTER"):
+        BleTools.select_adapter(os.environ["BLE_ADAPTER"])
+    trace.mark("imports")
+
+    app = Application()
+    logger.info(f"Application created")
+
+    # NetworkManager and MCU probes started here complete while the
+    # adapter is being powered
+    service = VpsService(0)
+    app.add_service(service)
+    adv = VpsAdvertisement(0, service)
+    adv.trace = trace
+    trace.mark("service")
 
     logger.info("Turning on bluetooth")
-    ok = start_bluetooth()
+    ok = start_bluetooth(app.bus)
     if not ok:
         logger.error(f"Failed to activate bluetooth")
     else:
         logger.info(f"Bluetooth activated")
+    trace.mark("adapter")
 
-    app = Application()
-    logger.info(f"Application created")
-    app.add_service(VpsService(0))
-    app.register()
-    adv = VpsAdvertisement(0)
     adv.register()
+    app.register()
     try:
         logger.info(f"Running the application")
         app.run()
     except KeyboardInterrupt:
         app.quit()
+        executor.shutdown()
@@ -0,0 +1,234 @@
+import bisect
+import functools
+import logging
+import os
+import struct
+import threading
+import time
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from executor import executor
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the latency buckets in milliseconds; one more bucket
+# collects everything slower than the last bound.
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+SNAPSHOT_VERSION = 2
+# version, bucket count, page, page count, name count, entry count
+SNAPSHOT_HEADER = struct.Struct("<BBBBBB")
+# name index, method id, calls, errors, total ms, mask of non-empty buckets
+SNAPSHOT_ENTRY = struct.Struct("<BBIIIH")
+SNAPSHOT_BUCKET = struct.Struct("<I")
+SNAPSHOT_NAME_SIZE = 64
+# a page must fit in one attribute value
+SNAPSHOT_PAGE_SIZE = 512
+
+TEXTFILE_PATH = "/var/lib/node_exporter/textfile_collector/vps_ble.prom"
+TEXTFILE_INTERVAL_MS = 15000
+
+# method name: id used in the binary snapshot
+METHOD_IDS = {
+    "ReadValue": 1,
+    "WriteValue": 2,
+    "StartNotify": 3,
+    "StopNotify": 4,
+    "AcquireNotify": 5,
+    "AcquireWrite": 6,
+    "notify": 7,
+    "post": 8,
+}
+
+
+class Histogram(object):
+    __slots__ = ("buckets", "calls", "errors", "total")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, elapsed_ms, error):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, elapsed_ms)] += 1
+        self.calls += 1
+        self.total += elapsed_ms
+        if error:
+            self.errors += 1
+
+
+class Metrics(object):
+    """
+    Call counts, error counts and fixed-bucket latency histograms keyed by
+    (name, method), where name is a characteristic UUID or an API path, and
+    plain event counters keyed the same way. Safe to update from executor
+    threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.timer = None
+
+    def observe(self, name, method, elapsed, error=False):
+        elapsed_ms = elapsed * 1000.0
+        with self.lock:
+            histogram = self.histograms.get((name, method))
+            if histogram is None:
+                histogram = self.histograms[(name, method)] = Histogram()
+            histogram.observe(elapsed_ms, error)
+
+    def count(self, name, method):
+        with self.lock:
+            self.counters[(name, method)] = self.counters.get((name, method), 0) + 1
+
+    def items(self):
+        with self.lock:
+            return [(name, method, list(h.buckets), h.calls, h.errors, h.total)
+                    for (name, method), h in sorted(self.histograms.items())]
+
+    def counter_items(self):
+        with self.lock:
+            return sorted(self.counters.items())
+
+    def snapshot(self, page=0):
+        """
+        Binary snapshot, split into pages of at most SNAPSHOT_PAGE_SIZE bytes.
+        A page is a SNAPSHOT_HEADER, the names it uses (uint8 length, UTF-8)
+        and its entries. Each entry refers to a name by index and is followed
+        by one uint32 count per bucket set in its mask. Counters are entries
+        without buckets. A page past the last one has no entries.
+        """
+        entries = [(name, method, calls, errors, total, buckets)
+                   for name, method, buckets, calls, errors, total in self.items()]
+        entries += [(name, method, value, 0, 0.0, ())
+                    for (name, method), value in self.counter_items()]
+
+        pages = [[]]
+        for entry in entries:
+            if pages[-1] and len(encode_page(pages[-1] + [entry], 0, 0)) > SNAPSHOT_PAGE_SIZE:
+                pages.append([])
+            pages[-1].append(entry)
+        return encode_page(pages[page] if page < len(pages) else [], page, len(pages))
+
+    def textfile(self):
+        lines = [
+            "# HELP vps_ble_handler_duration_seconds Handler latency.",
+            "# TYPE vps_ble_handler_duration_seconds histogram",
+        ]
+        errors = []
+        for name, method, buckets, calls, error_count, total in self.items():
+            labels = f'name="{name}",method="{method}"'
+            cumulative = 0
+            for bound, count in zip(BUCKET_BOUNDS_MS, buckets):
+                cumulative += count
+                lines.append(f'vps_ble_handler_duration_seconds_bucket{{{labels},le="{bound / 1000.0}"}} {cumulative}')
+            lines.append(f'vps_ble_handler_duration_seconds_bucket{{{labels},le="+Inf"}} {calls}')
+            lines.append(f"vps_ble_handler_duration_seconds_sum{{{labels}}} {total / 1000.0}")
+            lines.append(f"vps_ble_handler_duration_seconds_count{{{labels}}} {calls}")
+            errors.append(f"vps_ble_handler_errors_total{{{labels}}} {error_count}")
+        lines.append("# HELP vps_ble_handler_errors_total Handler calls that failed.")
+        lines.append("# TYPE vps_ble_handler_errors_total counter")
+        lines.extend(errors)
+        lines.append("# HELP vps_ble_events_total Events such as notifications sent.")
+        lines.append("# TYPE vps_ble_events_total counter")
+        for (name, method), value in self.counter_items():
+            lines.append(f'vps_ble_events_total{{name="{name}",event="{method}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def start_textfile(self, path=TEXTFILE_PATH, interval_ms=TEXTFILE_INTERVAL_MS):
+        if not os.path.isdir(os.path.dirname(path)):
+            logger.info(f"Not writing metrics, {os.path.dirname(path)} does not exist")
+            return
+        if self.timer is None:
+            self.timer = GObject.timeout_add(interval_ms, self.write_textfile, path)
+
+    def write_textfile(self, path):
+        executor.submit(write_atomic, path, self.textfile(),
+                        error_callback=lambda e: logger.error(f"Writing metrics to {path} failed: {e}"))
+        return True
+
+
+def encode_page(entries, page, page_count):
+    names = []
+    for entry in entries:
+        if entry[0] not in names:
+            names.append(entry[0])
+    parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, len(BUCKET_BOUNDS_MS) + 1,
+                                  min(page, 0xFF), min(page_count, 0xFF), len(names), len(entries))]
+    for name in names:
+        encoded = name.encode("utf-8")[:SNAPSHOT_NAME_SIZE]
+        parts.append(bytes((len(encoded),)) + encoded)
+    for name, method, calls, errors, total, buckets in entries:
+        mask = 0
+        counts = []
+        for index, count in enumerate(buckets):
+            if count:
+                mask |= 1 << index
+                counts.append(SNAPSHOT_BUCKET.pack(min(count, 0xFFFFFFFF)))
+        parts.append(SNAPSHOT_ENTRY.pack(names.index(name), METHOD_IDS.get(method, 0),
+                                         min(calls, 0xFFFFFFFF), min(errors, 0xFFFFFFFF),
+                                         min(int(total), 0xFFFFFFFF), mask))
+        parts.extend(counts)
+    return b"".join(parts)
+
+
+def write_atomic(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def instrument(func, name_attr, method, async_callbacks=None):
+    """
+    Wraps a handler so each call is recorded under (getattr(self, name_attr),
+    method). For D-Bus methods with async_callbacks the call is recorded
+    when the reply or error handler runs.
+    """
+    if async_callbacks:
+        reply_keyword, error_keyword = async_callbacks
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            name = getattr(self, name_attr)
+            start = time.monotonic()
+            reply_handler = kwargs[reply_keyword]
+            error_handler = kwargs[error_keyword]
+
+            def on_reply(*result):
+                metrics.observe(name, method, time.monotonic() - start)
+                reply_handler(*result)
+
+            def on_error(error):
+                metrics.observe(name, method, time.monotonic() - start, True)
+                error_handler(error)
+
+            kwargs[reply_keyword] = on_reply
+            kwargs[error_keyword] = on_error
+            try:
+                return func(self, *args, **kwargs)
+            except Exception:
+                metrics.observe(name, method, time.monotonic() - start, True)
+                raise
+    else:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception:
+                metrics.observe(getattr(self, name_attr), method, time.monotonic() - start, True)
+                raise
+            metrics.observe(getattr(self, name_attr), method, time.monotonic() - start)
+            return result
+
+    wrapper._metrics_instrumented = True
+    return wrapper
+
+
+metrics = Metrics()
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+"""
+Stand-ins for the system services the VPS BLE service talks to, for running
+it on a private bus: org.bluez with one adapter (Adapter1, GattManager1,
+LEAdvertisingManager1), the MCU battery service and a NetworkManager with one
+Wi-Fi device. The bus address is taken from VPS_DBUS_ADDRESS.
+"""
+import logging
+import os
+import time
+import dbus
+import dbus.mainloop.glib
+import dbus.service
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from bletools import DBUS_ADDRESS_ENV
+from battery import MCU_SERVICE_NAME, MCU_OBJECT_PATH, MCU_IFACE
+from wifi import (NM_SERVICE_NAME, NM_OBJECT_PATH, NM_IFACE, NM_DEVICE_IFACE,
+                  NM_WIRELESS_IFACE, NM_AP_IFACE, NM_ACTIVE_CONNECTION_IFACE,
+                  NM_DEVICE_TYPE_WIFI, NO_OBJECT)
+
+logger = logging.getLogger(__name__)
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+ADAPTER_PATH = "/org/bluez/hci0"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+MOCK_IFACE = "io.vpsrecorder.Mock1"
+
+NM_DEVICE_PATH = NM_OBJECT_PATH + "/Devices/0"
+NM_AP_PATH = NM_OBJECT_PATH + "/AccessPoint/%d"
+NM_ACTIVE_PATH = NM_OBJECT_PATH + "/ActiveConnection/%d"
+NM_STATE_CONNECTED_GLOBAL = 70
+NM_ACTIVE_CONNECTION_STATE_ACTIVATING = 1
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+NM_DEVICE_STATE_CONFIG = 50
+NM_DEVICE_STATE_IP_CONFIG = 70
+NM_DEVICE_STATE_ACTIVATED = 100
+MOCK_ACCESS_POINTS = (b"vps-lab", b"vps-guest", b"office")
+MOCK_BATTERY_LEVEL = 87
+MOCK_ACTIVATION_MS = 100
+
+
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
+
+
+class MockObject(dbus.service.Object):
+    """
+    Object with org.freedesktop.DBus.Properties backed by a dict of
+    interface -> {name: value}.
+    """
+    def __init__(self, bus, path, properties):
+        self.bus = bus
+        self.path = path
+        self.properties = properties
+        dbus.service.Object.__init__(self, bus, path)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ss", out_signature="v")
+    def Get(self, interface, name):
+        try:
+            return self.properties[interface][name]
+        except KeyError:
+            raise InvalidArgsException()
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
+    def GetAll(self, interface):
+        return dbus.Dictionary(self.properties.get(interface, {}), signature="sv")
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        if name not in self.properties.get(interface, {}):
+            raise InvalidArgsException()
+        self.set_property(interface, name, value)
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def set_property(self, interface, name, value):
+        self.properties[interface][name] = value
+        self.PropertiesChanged(interface, {name: value}, [])
+
+
+class MockBluez(dbus.service.Object):
+    """
+    The org.bluez root object. Also records when applications and
+    advertisements register, for the benchmark harness (io.vpsrecorder.Mock1).
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self.events = {}
+        self.application = ""
+        dbus.service.Object.__init__(self, bus, "/")
+        self.adapter = MockAdapter(bus, self)
+
+    def record(self, name):
+        self.events[name] = time.time()
+        logger.debug(f"{name} at {self.events[name]:.3f}")
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return {dbus.ObjectPath(ADAPTER_PATH): self.adapter.get_interfaces()}
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
+
+    @dbus.service.method(MOCK_IFACE, out_signature="a{sd}")
+    def GetEvents(self):
+        return dbus.Dictionary(self.events, signature="sd")
+
+    @dbus.service.method(MOCK_IFACE, out_signature="s")
+    def GetApplication(self):
+        return self.application
+
+    @dbus.service.method(MOCK_IFACE)
+    def Reset(self):
+        self.events.clear()
+        self.application = ""
+        self.adapter.properties[ADAPTER_IFACE].update(MockAdapter.DEFAULTS)
+
+
+class MockAdapter(MockObject):
+    DEFAULTS = {
+        "Powered": dbus.Boolean(False),
+        "Discoverable": dbus.Boolean(False),
+        "DiscoverableTimeout": dbus.UInt32(180),
+    }
+
+    def __init__(self, bus, root):
+        self.root = root
+        properties = dict(self.DEFAULTS)
+        properties["Address"] = dbus.String("00:00:00:00:00:01")
+        properties["Alias"] = dbus.String("vps-mock")
+        MockObject.__init__(self, bus, ADAPTER_PATH, {ADAPTER_IFACE: properties})
+
+    def get_interfaces(self):
+        return {
+            ADAPTER_IFACE: self.properties[ADAPTER_IFACE],
+            GATT_MANAGER_IFACE: {},
+            LE_ADVERTISING_MANAGER_IFACE: {},
+        }
+
+    def set_property(self, interface, name, value):
+        MockObject.set_property(self, interface, name, value)
+        self.root.record(f"{name}={value}")
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply_handler", "error_handler"))
+    def RegisterApplication(self, path, options, sender=None, reply_handler=None,
+                            error_handler=None):
+        # BlueZ reads the whole object tree before replying
+        def on_objects(objects):
+            self.root.application = sender
+            self.root.record("RegisterApplication")
+            reply_handler()
+
+        self.bus.get_object(sender, path, introspect=False).GetManagedObjects(
+                dbus_interface=DBUS_OM_IFACE,
+                reply_handler=on_objects,
+                error_handler=error_handler)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="o")
+    def UnregisterApplication(self, path):
+        self.root.record("UnregisterApplication")
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply_handler", "error_handler"))
+    def RegisterAdvertisement(self, path, options, sender=None, reply_handler=None,
+                              error_handler=None):
+        def on_properties(properties):
+            self.root.record("RegisterAdvertisement")
+            reply_handler()
+
+        self.bus.get_object(sender, path, introspect=False).GetAll(
+                "org.bluez.LEAdvertisement1",
+                dbus_interface=DBUS_PROP_IFACE,
+                reply_handler=on_properties,
+                error_handler=error_handler)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="o")
+    def UnregisterAdvertisement(self, path):
+        self.root.record("UnregisterAdvertisement")
+
+
+class MockMcu(dbus.service.Object):
+    def __init__(self, bus, level=MOCK_BATTERY_LEVEL):
+        self.level = level
+        dbus.service.Object.__init__(self, bus, MCU_OBJECT_PATH)
+
+    @dbus.service.method(MCU_IFACE, in_signature="b", out_signature="y")
+    def getBatterySOC(self, refresh):
+        return self.level
+
+    @dbus.service.signal(MCU_IFACE, signature="y")
+    def batterySOCChanged(self, level):
+        pass
+
+
+class MockNetworkManager(MockObject):
+    def __init__(self, bus):
+        self.active = []
+        MockObject.__init__(self, bus, NM_OBJECT_PATH, {
+            NM_IFACE: {"State": dbus.UInt32(NM_STATE_CONNECTED_GLOBAL)},
+        })
+        self.access_points = [MockAccessPoint(bus, NM_AP_PATH % i, ssid, 80 - i * 15)
+                              for i, ssid in enumerate(MOCK_ACCESS_POINTS)]
+        self.device = MockWifiDevice(bus, self.access_points)
+
+    @dbus.service.method(NM_IFACE, out_signature="ao")
+    def GetDevices(self):
+        return dbus.Array([NM_DEVICE_PATH], signature="o")
+
+    @dbus.service.method(NM_IFACE, in_signature="a{sa{sv}}ooa{sv}", out_signature="ooa{sv}")
+    def AddAndActivateConnection2(self, settings, device, specific_object, options):
+        active = MockActiveConnection(self.bus, NM_ACTIVE_PATH % len(self.active))
+        self.active.append(active)
+        # ACTIVATING -> device in IP_CONFIG -> ACTIVATED, MOCK_ACTIVATION_MS apart
+        steps = [
+            lambda: self.device.StateChanged(NM_DEVICE_STATE_IP_CONFIG, NM_DEVICE_STATE_CONFIG, 0),
+            lambda: active.set_state(NM_ACTIVE_CONNECTION_STATE_ACTIVATED),
+            lambda: self.device.StateChanged(NM_DEVICE_STATE_ACTIVATED, NM_DEVICE_STATE_IP_CONFIG, 0),
+        ]
+        GObject.timeout_add(MOCK_ACTIVATION_MS, self.activation_step, steps)
+        return (dbus.ObjectPath(NO_OBJECT), dbus.ObjectPath(active.path),
+                dbus.Dictionary({}, signature="sv"))
+
+    def activation_step(self, steps):
+        steps.pop(0)()
+        return bool(steps)
+
+    @dbus.service.method(NM_IFACE, in_signature="o")
+    def DeactivateConnection(self, active):
+        pass
+
+    @dbus.service.signal(NM_IFACE, signature="u")
+    def StateChanged(self, state):
+        pass
+
+
+class MockWifiDevice(MockObject):
+    def __init__(self, bus, access_points):
+        self.access_points = access_points
+        MockObject.__init__(self, bus, NM_DEVICE_PATH, {
+            NM_DEVICE_IFACE: {"DeviceType": dbus.UInt32(NM_DEVICE_TYPE_WIFI)},
+            NM_WIRELESS_IFACE: {"ActiveAccessPoint": dbus.ObjectPath(access_points[0].path)},
+        })
+
+    @dbus.service.method(NM_WIRELESS_IFACE, out_signature="ao")
+    def GetAllAccessPoints(self):
+        return dbus.Array([ap.path for ap in self.access_points], signature="o")
+
+    @dbus.service.method(NM_WIRELESS_IFACE, in_signature="a{sv}")
+    def RequestScan(self, options):
+        pass
+
+    @dbus.service.signal(NM_WIRELESS_IFACE, signature="o")
+    def AccessPointAdded(self, path):
+        pass
+
+    @dbus.service.signal(NM_WIRELESS_IFACE, signature="o")
+    def AccessPointRemoved(self, path):
+        pass
+
+    @dbus.service.signal(NM_DEVICE_IFACE, signature="uuu")
+    def StateChanged(self, new_state, old_state, reason):
+        pass
+
+
+class MockAccessPoint(MockObject):
+    def __init__(self, bus, path, ssid, strength):
+        MockObject.__init__(self, bus, path, {
+            NM_AP_IFACE: {
+                "Ssid": dbus.ByteArray(ssid),
+                "Strength": dbus.Byte(strength),
+                "Flags": dbus.UInt32(1),
+                "WpaFlags": dbus.UInt32(0),
+                "RsnFlags": dbus.UInt32(0x188),
+                "Frequency": dbus.UInt32(2437),
+            },
+        })
+
+
+class MockActiveConnection(MockObject):
+    def __init__(self, bus, path):
+        MockObject.__init__(self, bus, path, {
+            NM_ACTIVE_CONNECTION_IFACE: {"State": dbus.UInt32(NM_ACTIVE_CONNECTION_STATE_ACTIVATING)},
+        })
+
+    @dbus.service.signal(NM_ACTIVE_CONNECTION_IFACE, signature="uu")
+    def StateChanged(self, state, reason):
+        pass
+
+    def set_state(self, state):
+        self.set_property(NM_ACTIVE_CONNECTION_IFACE, "State", dbus.UInt32(state))
+        self.StateChanged(state, 0)
+
+
+def start_mocks(bus):
+    names = [dbus.service.BusName(name, bus) for name in
+             (BLUEZ_SERVICE_NAME, MCU_SERVICE_NAME, NM_SERVICE_NAME)]
+    return names, MockBluez(bus), MockMcu(bus), MockNetworkManager(bus)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING"))
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(os.environ[DBUS_ADDRESS_ENV])
+    mocks = start_mocks(bus)
+    GObject.MainLoop().run()
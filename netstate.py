@@ -0,0 +1,219 @@
+import errno
+import logging
+import socket
+import struct
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+logger = logging.getLogger(__name__)
+
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFLA_IFNAME = 3
+RT_SCOPE_UNIVERSE = 0
+
+NLMSG_HDR = struct.Struct("=IHHII")
+IFADDRMSG = struct.Struct("=BBBBI")
+IFINFOMSG = struct.Struct("=BxHiII")
+RTATTR = struct.Struct("=HH")
+
+RECV_SIZE = 65536
+PREFERRED_INTERFACES = ("wlan0", "eth0")
+
+
+def align(length):
+    return (length + 3) & ~3
+
+
+def parse_messages(data):
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        length, msg_type, flags, seq, pid = NLMSG_HDR.unpack_from(data, offset)
+        if length < NLMSG_HDR.size:
+            break
+        yield msg_type, data[offset + NLMSG_HDR.size:offset + length]
+        offset += align(length)
+
+
+def parse_attributes(payload, offset):
+    attrs = {}
+    while offset + RTATTR.size <= len(payload):
+        attr_len, attr_type = RTATTR.unpack_from(payload, offset)
+        if attr_len < RTATTR.size:
+            break
+        attrs[attr_type] = payload[offset + RTATTR.size:offset + attr_len]
+        offset += align(attr_len)
+    return attrs
+
+
+def parse_link(payload):
+    family, link_type, index, flags, change = IFINFOMSG.unpack_from(payload)
+    raw = parse_attributes(payload, IFINFOMSG.size).get(IFLA_IFNAME)
+    if raw is None:
+        return index, None
+    return index, raw.split(b"\0", 1)[0].decode()
+
+
+def parse_address(payload):
+    family, prefixlen, flags, scope, index = IFADDRMSG.unpack_from(payload)
+    attrs = parse_attributes(payload, IFADDRMSG.size)
+
+    # IFA_LOCAL is the local address on point-to-point links, where
+    # IFA_ADDRESS holds the peer; IPv6 only ever sets IFA_ADDRESS.
+    raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+    if raw is None:
+        return None
+    return index, family, scope, socket.inet_ntop(family, raw)
+
+
+class NetworkState(object):
+    """
+    In-memory index of interface addresses. It is filled from one rtnetlink
+    RTM_GETADDR dump and then kept current from address and link events
+    read on the GLib loop, so lookups never touch the kernel. If the kernel
+    drops events because the socket buffer overflowed, the dump is re-run.
+    """
+    def __init__(self, preferred_interfaces=PREFERRED_INTERFACES):
+        self.preferred_interfaces = preferred_interfaces
+        self.addresses = {}
+        self.names = {}
+        self.listeners = []
+        self.primary_address = None
+        self.sock = None
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK,
+                                  socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        self.load()
+        GObject.io_add_watch(self.sock.fileno(), GObject.IO_IN, self.readable)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def load(self):
+        self.addresses.clear()
+        self.names.clear()
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            request = NLMSG_HDR.pack(NLMSG_HDR.size + IFADDRMSG.size, RTM_GETADDR,
+                                     NLM_F_REQUEST | NLM_F_DUMP, 1, 0)
+            sock.send(request + IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+            done = False
+            while not done:
+                data = sock.recv(RECV_SIZE)
+                if not data:
+                    break
+                for msg_type, payload in parse_messages(data):
+                    if msg_type in (NLMSG_DONE, NLMSG_ERROR):
+                        done = True
+                        break
+                    self.handle_message(msg_type, payload)
+        self.update_primary()
+
+    def readable(self, fd, condition):
+        changed = set()
+        while True:
+            try:
+                data = self.sock.recv(RECV_SIZE)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    logger.error(f"Reading netlink events failed: {e}")
+                    break
+                # events were dropped, so the index may be stale
+                logger.warning("Netlink events lost, reloading addresses")
+                changed.update(self.addresses)
+                self.load()
+                changed.update(self.addresses)
+                continue
+            for msg_type, payload in parse_messages(data):
+                changed.update(self.handle_message(msg_type, payload))
+
+        if changed:
+            self.update_primary()
+            for name in changed:
+                logger.debug(f"Addresses changed on {name}: {self.get_addresses(name)}")
+                for listener in self.listeners:
+                    listener(name)
+        return True
+
+    def handle_message(self, msg_type, payload):
+        """
+        Applies one netlink message and returns the names of the interfaces
+        whose addresses changed.
+        """
+        if msg_type in (RTM_NEWLINK, RTM_DELLINK):
+            return self.handle_link(msg_type, *parse_link(payload))
+        if msg_type not in (RTM_NEWADDR, RTM_DELADDR):
+            return ()
+        parsed = parse_address(payload)
+        if parsed is None:
+            return ()
+        index, family, scope, address = parsed
+        name = self.get_name(index)
+        entries = self.addresses.setdefault(name, [])
+        entry = (family, scope, address)
+        if msg_type == RTM_NEWADDR:
+            if entry not in entries:
+                entries.append(entry)
+        elif entry in entries:
+            entries.remove(entry)
+        return (name,)
+
+    def handle_link(self, msg_type, index, name):
+        old_name = self.names.get(index)
+        if old_name is None:
+            return ()
+        if msg_type == RTM_DELLINK:
+            del self.names[index]
+            self.addresses.pop(old_name, None)
+            return (old_name,)
+        if name is None or name == old_name:
+            return ()
+        # renamed: move its addresses to the new name
+        self.names[index] = name
+        entries = self.addresses.pop(old_name, None)
+        if entries is not None:
+            self.addresses[name] = entries
+        return (old_name, name)
+
+    def get_name(self, index):
+        name = self.names.get(index)
+        if name is None:
+            try:
+                name = socket.if_indextoname(index)
+            except OSError:
+                name = str(index)
+            self.names[index] = name
+        return name
+
+    def get_addresses(self, name, family=None):
+        return [address for entry_family, scope, address in self.addresses.get(name, ())
+                if family is None or entry_family == family]
+
+    def find_primary_address(self):
+        names = list(self.preferred_interfaces)
+        names += [name for name in self.addresses if name not in names]
+        for name in names:
+            for family, scope, address in self.addresses.get(name, ()):
+                if family == socket.AF_INET and scope == RT_SCOPE_UNIVERSE:
+                    return address
+        return None
+
+    def update_primary(self):
+        self.primary_address = self.find_primary_address()
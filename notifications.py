@@ -0,0 +1,124 @@
+import collections
+import logging
+import time
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_INTERVAL_MS = 30
+NOTIFY_BUDGET = 4
+MAX_STREAM_BACKLOG = 256
+
+
+class NotificationScheduler(object):
+    """
+    Single path for all characteristic notifications. Values submitted with
+    coalesce=True replace any value still pending for the same characteristic;
+    stream values (terminal output, scan pages) are frames of larger messages
+    and are queued in order, never dropped. Once a stream holds `max_backlog`
+    values its producer is asked to pause until the backlog has drained to
+    half of that. At most `budget`
+    notifications are sent per `interval_ms`, shared round-robin between
+    characteristics. A value refused by a full acquired socket is kept and
+    retried on the next interval.
+    """
+    def __init__(self, interval_ms=NOTIFY_INTERVAL_MS, budget=NOTIFY_BUDGET,
+                 max_backlog=MAX_STREAM_BACKLOG):
+        self.interval_ms = interval_ms
+        self.budget = budget
+        self.max_backlog = max_backlog
+        self.latest = collections.OrderedDict()
+        self.streams = collections.OrderedDict()
+        self.timer = None
+        self.last_drain = 0.0
+        self.drained_callbacks = {}
+
+    def submit(self, characteristic, value, coalesce=True):
+        """
+        Returns False when the stream of `characteristic` is backed up; the
+        producer should then stop until its when_drained() callback runs.
+        """
+        room = True
+        if coalesce:
+            self.latest[characteristic] = value
+        else:
+            queue = self.streams.setdefault(characteristic, collections.deque())
+            queue.append(value)
+            room = len(queue) < self.max_backlog
+        self.schedule()
+        return room
+
+    def when_drained(self, characteristic, callback):
+        if self.backlog(characteristic) <= self.max_backlog // 2:
+            callback()
+        else:
+            self.drained_callbacks.setdefault(characteristic, []).append(callback)
+
+    def backlog(self, characteristic):
+        return len(self.streams.get(characteristic, ()))
+
+    def pending(self):
+        return bool(self.latest or self.streams)
+
+    def schedule(self):
+        if self.timer is not None:
+            return
+        elapsed_ms = (time.monotonic() - self.last_drain) * 1000.0
+        if elapsed_ms >= self.interval_ms:
+            self.drain()
+            # a drained callback may have scheduled already
+            if self.timer is not None or not self.pending():
+                return
+            delay_ms = self.interval_ms
+        else:
+            delay_ms = int(self.interval_ms - elapsed_ms) + 1
+        self.timer = GObject.timeout_add(delay_ms, self.tick)
+
+    def tick(self):
+        self.drain()
+        if self.pending():
+            return True
+        self.timer = None
+        return False
+
+    def drain(self):
+        self.last_drain = time.monotonic()
+        budget = self.budget
+        while budget > 0 and self.pending():
+            blocked = []
+            for characteristic in list(self.latest):
+                if budget == 0:
+                    break
+                value = self.latest.pop(characteristic)
+                budget -= 1
+                if not self.send(characteristic, value):
+                    blocked.append(characteristic)
+                    self.latest.setdefault(characteristic, value)
+            for characteristic in list(self.streams):
+                if budget == 0:
+                    break
+                queue = self.streams[characteristic]
+                value = queue.popleft()
+                budget -= 1
+                if not self.send(characteristic, value):
+                    blocked.append(characteristic)
+                    queue.appendleft(value)
+                if queue:
+                    self.streams.move_to_end(characteristic)
+                else:
+                    del self.streams[characteristic]
+            if blocked:
+                # acquired sockets are full; retry on the next interval
+                break
+        for characteristic in list(self.drained_callbacks):
+            if self.backlog(characteristic) <= self.max_backlog // 2:
+                for callback in self.drained_callbacks.pop(characteristic):
+                    callback()
+
+    def send(self, characteristic, value):
+        if not getattr(characteristic, "notifying", False):
+            return True
+        return characteristic.send_notification(value)
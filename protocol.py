@@ -0,0 +1,221 @@
+import struct
+
+FRAME_MARKER = 0xF8
+FRAME_FIRST = 0x01
+FRAME_LAST = 0x02
+FRAME_HEADER_SIZE = 2
+
+DEFAULT_MTU = 23
+ATT_NOTIFY_OVERHEAD = 3
+# Longest attribute value a long read can return (Core spec, Vol 3, Part F)
+MAX_ATTRIBUTE_SIZE = 512
+
+AP_OP_UPDATE = 0x01
+AP_OP_REMOVE = 0x02
+AP_SECURITY_PRIVACY = 0x01
+AP_SECURITY_WPA = 0x02
+AP_SECURITY_RSN = 0x04
+AP_SSID_SIZE = 32
+# op, id, strength, security, frequency (MHz), ssid length, ssid
+AP_RECORD = struct.Struct("<BHBBHB%ds" % AP_SSID_SIZE)
+AP_REMOVED = struct.Struct("<BH")
+
+PROTOCOL_VERSION = 0x01
+TLV_HEADER = struct.Struct("<BB")
+TLV_EXTENDED_LENGTH = 0xFF
+TLV_LENGTH = struct.Struct("<H")
+
+FIELD_BATTERY = 0x01            # u8, percent
+FIELD_RECORDING = 0x02          # u8, 0 or 1
+FIELD_STORAGE_FREE = 0x03       # u32, MiB
+FIELD_TEMPERATURE = 0x04        # i16, 0.1 degC
+FIELD_ERRORS = 0x05             # u16, ERROR_* bits
+FIELD_WIFI_STATE = 0x06         # u8, WIFI_STATE_* code
+FIELD_REASON = 0x07             # u16, NetworkManager or provisioning reason
+FIELD_SSID = 0x08               # bytes
+FIELD_PASSWORD = 0x09           # bytes
+FIELD_OPCODE = 0x10             # u8
+FIELD_PAYLOAD = 0x11            # bytes
+FIELD_SEQUENCE = 0x12           # u8, echoed back in acknowledgements
+FIELD_RESULT = 0x13             # u8, RESULT_* code
+
+FIELD_FORMATS = {
+    FIELD_BATTERY: struct.Struct("<B"),
+    FIELD_RECORDING: struct.Struct("<B"),
+    FIELD_STORAGE_FREE: struct.Struct("<I"),
+    FIELD_TEMPERATURE: struct.Struct("<h"),
+    FIELD_ERRORS: struct.Struct("<H"),
+    FIELD_WIFI_STATE: struct.Struct("<B"),
+    FIELD_REASON: struct.Struct("<H"),
+    FIELD_OPCODE: struct.Struct("<B"),
+    FIELD_SEQUENCE: struct.Struct("<B"),
+    FIELD_RESULT: struct.Struct("<B"),
+}
+
+OPCODE_START_RECORDING = 0x01
+OPCODE_STOP_RECORDING = 0x02
+OPCODE_START_FRONT_LIVE = 0x03
+OPCODE_STOP_FRONT_LIVE = 0x04
+OPCODE_START_EYE_LIVE = 0x05
+OPCODE_STOP_EYE_LIVE = 0x06
+OPCODE_UPDATE_RECORDING_SETTINGS = 0x07
+OPCODE_UPDATE_MISCELLANEOUS_SETTINGS = 0x08
+
+RESULT_OK = 0x00
+RESULT_FAILED = 0x01
+RESULT_INVALID = 0x02
+RESULT_UNKNOWN_OPCODE = 0x03
+
+ERROR_BATTERY_UNAVAILABLE = 0x0001
+ERROR_RECORDER_API = 0x0002
+ERROR_STORAGE_LOW = 0x0004
+
+# Status broadcast in the advertisement's service data, so scanners can show
+# it without connecting: version, battery percent, ADV_FLAG_* bits and the
+# low byte of the ERROR_* bits.
+ADV_STATUS = struct.Struct("<BBBB")
+ADV_BATTERY_UNKNOWN = 0xFF
+ADV_FLAG_RECORDING = 0x01
+ADV_FLAG_WIFI_CONNECTED = 0x02
+
+WIFI_STATE_CODES = {
+    "idle": 0,
+    "queued": 1,
+    "associating": 2,
+    "dhcp": 3,
+    "connected": 4,
+    "failed": 5,
+}
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def frame_payload_size(mtu):
+    return max(1, int(mtu) - ATT_NOTIFY_OVERHEAD - FRAME_HEADER_SIZE)
+
+
+def get_mtu(options):
+    return int(options.get("mtu", DEFAULT_MTU))
+
+
+class ChunkFramer(object):
+    """
+    Splits a byte stream into notifications that fit the negotiated ATT MTU.
+    Every frame starts with a marker/flags byte and a sequence number, so the
+    central can detect the first and last frame of a message and any gaps.
+    """
+    def __init__(self, mtu=DEFAULT_MTU):
+        self.payload_size = frame_payload_size(mtu)
+        self.seq = 0
+        self.started = False
+
+    def header(self, last=False):
+        flags = FRAME_MARKER
+        if not self.started:
+            flags |= FRAME_FIRST
+            self.started = True
+        if last:
+            flags |= FRAME_LAST
+        header = bytes((flags, self.seq))
+        self.seq = (self.seq + 1) & 0xFF
+        return header
+
+    def feed(self, data):
+        frames = []
+        for start in range(0, len(data), self.payload_size):
+            frames.append(self.header() + data[start:start + self.payload_size])
+        return frames
+
+    def frame_message(self, data):
+        self.started = False
+        frames = []
+        for start in range(0, max(len(data), 1), self.payload_size):
+            last = start + self.payload_size >= len(data)
+            frames.append(self.header(last) + data[start:start + self.payload_size])
+        return frames
+
+    def finish(self):
+        return self.header(last=True)
+
+
+def encode_message(fields):
+    """
+    Encodes {field: value} as a version byte followed by type-length-value
+    entries. Integer fields use their FIELD_FORMATS layout, others are bytes.
+    """
+    message = bytearray((PROTOCOL_VERSION,))
+    for field, value in fields.items():
+        if value is None:
+            continue
+        fmt = FIELD_FORMATS.get(field)
+        value = fmt.pack(value) if fmt is not None else bytes(value)
+        if len(value) < TLV_EXTENDED_LENGTH:
+            message += TLV_HEADER.pack(field, len(value))
+        else:
+            message += TLV_HEADER.pack(field, TLV_EXTENDED_LENGTH)
+            message += TLV_LENGTH.pack(len(value))
+        message += value
+    return bytes(message)
+
+
+def decode_message(data):
+    """
+    Decodes a message from encode_message(). Unknown fields are returned as
+    raw bytes so newer senders can add fields without breaking old readers;
+    a known fixed-size field with any other length is a ProtocolError.
+    """
+    data = bytes(data)
+    if not data or data[0] != PROTOCOL_VERSION:
+        raise ProtocolError("Unsupported protocol version")
+
+    fields = {}
+    offset = 1
+    while offset < len(data):
+        if offset + TLV_HEADER.size > len(data):
+            raise ProtocolError("Truncated field header")
+        field, length = TLV_HEADER.unpack_from(data, offset)
+        offset += TLV_HEADER.size
+        if length == TLV_EXTENDED_LENGTH:
+            if offset + TLV_LENGTH.size > len(data):
+                raise ProtocolError("Truncated field length")
+            length, = TLV_LENGTH.unpack_from(data, offset)
+            offset += TLV_LENGTH.size
+        if offset + length > len(data):
+            raise ProtocolError(f"Truncated value for field {field:#04x}")
+        value = data[offset:offset + length]
+        offset += length
+
+        fmt = FIELD_FORMATS.get(field)
+        if fmt is not None:
+            if fmt.size != length:
+                raise ProtocolError(f"Field {field:#04x} has {length} bytes, expected {fmt.size}")
+            value, = fmt.unpack(value)
+        fields[field] = value
+    return fields
+
+
+def is_message(data):
+    return len(data) > 0 and data[0] == PROTOCOL_VERSION
+
+
+def encode_access_point(ap_id, ssid, strength, security, frequency):
+    ssid = ssid[:AP_SSID_SIZE]
+    return AP_RECORD.pack(AP_OP_UPDATE, ap_id, strength, security, frequency,
+                          len(ssid), ssid)
+
+
+def encode_access_point_removed(ap_id):
+    return AP_REMOVED.pack(AP_OP_REMOVE, ap_id)
+
+
+def encode_status_advertisement(battery, recording, wifi_connected, errors):
+    flags = 0
+    if recording:
+        flags |= ADV_FLAG_RECORDING
+    if wifi_connected:
+        flags |= ADV_FLAG_WIFI_CONNECTED
+    if battery is None:
+        battery = ADV_BATTERY_UNKNOWN
+    return ADV_STATUS.pack(PROTOCOL_VERSION, battery, flags, errors & 0xFF)
@@ -0,0 +1,169 @@
+import logging
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from wifi import NM_ACTIVE_CONNECTION_IFACE
+
+logger = logging.getLogger(__name__)
+
+STATE_IDLE = "idle"
+STATE_QUEUED = "queued"
+STATE_ASSOCIATING = "associating"
+STATE_DHCP = "dhcp"
+STATE_CONNECTED = "connected"
+STATE_FAILED = "failed"
+
+# NMActiveConnectionState values of the connection being provisioned
+NM_ACTIVE_CONNECTION_STATE_ACTIVATING = 1
+NM_ACTIVE_CONNECTION_STATE_ACTIVATED = 2
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATING = 3
+NM_ACTIVE_CONNECTION_STATE_DEACTIVATED = 4
+
+ACTIVE_STATES = {
+    NM_ACTIVE_CONNECTION_STATE_ACTIVATING: STATE_ASSOCIATING,
+    NM_ACTIVE_CONNECTION_STATE_ACTIVATED: STATE_CONNECTED,
+    NM_ACTIVE_CONNECTION_STATE_DEACTIVATING: STATE_FAILED,
+    NM_ACTIVE_CONNECTION_STATE_DEACTIVATED: STATE_FAILED,
+}
+
+# NMDeviceState values only refine an activating connection: they tell
+# association from DHCP, and a device failure carries the better reason
+NM_DEVICE_STATE_PREPARE = 40
+NM_DEVICE_STATE_CONFIG = 50
+NM_DEVICE_STATE_NEED_AUTH = 60
+NM_DEVICE_STATE_IP_CONFIG = 70
+NM_DEVICE_STATE_IP_CHECK = 80
+NM_DEVICE_STATE_SECONDARIES = 90
+NM_DEVICE_STATE_FAILED = 120
+
+DEVICE_STATES = {
+    NM_DEVICE_STATE_PREPARE: STATE_ASSOCIATING,
+    NM_DEVICE_STATE_CONFIG: STATE_ASSOCIATING,
+    NM_DEVICE_STATE_NEED_AUTH: STATE_ASSOCIATING,
+    NM_DEVICE_STATE_IP_CONFIG: STATE_DHCP,
+    NM_DEVICE_STATE_IP_CHECK: STATE_DHCP,
+    NM_DEVICE_STATE_SECONDARIES: STATE_DHCP,
+    NM_DEVICE_STATE_FAILED: STATE_FAILED,
+}
+
+# Failure reasons outside the NMDeviceStateReason range
+REASON_NONE = 0
+REASON_REQUEST_FAILED = 0xFFFE
+REASON_TIMEOUT = 0xFFFF
+
+PROVISIONING_TIMEOUT_MS = 60000
+
+
+class WifiProvisioner(object):
+    """
+    Drives one Wi-Fi connect request at a time through queued, associating,
+    dhcp and connected (or failed with a reason) and reports every transition
+    to its listeners. A new request cancels the one still in flight.
+    Progress follows the active connection NetworkManager returned for the
+    request; device states only add the dhcp step and failure reasons.
+    """
+    def __init__(self, wifi, timeout_ms=PROVISIONING_TIMEOUT_MS):
+        self.wifi = wifi
+        self.timeout_ms = timeout_ms
+        self.state = STATE_IDLE
+        self.reason = REASON_NONE
+        self.ssid = None
+        self.request_id = 0
+        self.active = None
+        self.active_match = None
+        self.timer = None
+        self.listeners = []
+        wifi.add_device_state_listener(self.device_state_changed)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def in_progress(self):
+        return self.state in (STATE_QUEUED, STATE_ASSOCIATING, STATE_DHCP)
+
+    def request(self, ssid, password):
+        if self.in_progress():
+            logger.info(f"Cancelling Wi-Fi provisioning of {self.ssid}")
+            if self.active is not None:
+                self.wifi.deactivate(self.active)
+        self.finish_request()
+
+        self.ssid = ssid
+        self.request_id += 1
+        request_id = self.request_id
+        self.set_state(STATE_QUEUED)
+        self.timer = GObject.timeout_add(self.timeout_ms, self.timed_out)
+
+        def on_active(active):
+            if request_id != self.request_id or not self.in_progress():
+                return
+            self.active = active = str(active)
+            self.active_match = self.wifi.watch_active_connection(
+                    active, self.active_state_changed)
+
+            def on_state(state):
+                # the connection may have changed state before we subscribed
+                if self.active == active:
+                    self.active_state_changed(int(state), REASON_NONE)
+
+            self.wifi.get_property_async(active, NM_ACTIVE_CONNECTION_IFACE, "State", on_state)
+
+        def on_error(error):
+            if request_id != self.request_id:
+                return
+            logger.error(f"Connecting to Wi-Fi network {ssid} failed: {error}")
+            self.fail(REASON_REQUEST_FAILED)
+
+        self.wifi.connect(ssid, password, on_active, on_error)
+
+    def device_state_changed(self, device_state, reason):
+        # before ACTIVATING the device may still report an earlier connection
+        if self.state not in (STATE_ASSOCIATING, STATE_DHCP):
+            return
+        state = DEVICE_STATES.get(device_state)
+        if state == STATE_FAILED:
+            self.fail(reason)
+        elif state is not None:
+            self.set_state(state)
+
+    def active_state_changed(self, active_state, reason):
+        if not self.in_progress():
+            return
+        state = ACTIVE_STATES.get(active_state)
+        if state == STATE_FAILED:
+            self.fail(reason)
+        elif state == STATE_CONNECTED:
+            self.finish_request()
+            self.set_state(STATE_CONNECTED)
+        elif state == STATE_ASSOCIATING and self.state == STATE_QUEUED:
+            self.set_state(state)
+
+    def timed_out(self):
+        self.timer = None
+        if self.in_progress():
+            self.fail(REASON_TIMEOUT)
+        return False
+
+    def fail(self, reason):
+        self.finish_request()
+        self.set_state(STATE_FAILED, reason)
+
+    def finish_request(self):
+        if self.timer is not None:
+            GObject.source_remove(self.timer)
+            self.timer = None
+        if self.active_match is not None:
+            self.active_match.remove()
+            self.active_match = None
+        self.active = None
+
+    def set_state(self, state, reason=REASON_NONE):
+        if state == self.state and reason == self.reason:
+            return
+        self.state = state
+        self.reason = reason
+        logger.info(f"Wi-Fi provisioning of {self.ssid}: {state} ({reason})")
+        for listener in self.listeners:
+            listener(state, reason)
@@ -19,6 +19,9 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import logging
+import socket
+import time
 import dbus
 import dbus.mainloop.glib
 import dbus.exceptions
@@ -27,6 +30,13 @@ try:
 except ImportError:
     import gobject as GObject
 from bletools import BleTools
+from sessions import SessionManager
+from notifications import NotificationScheduler
+from metrics import metrics, instrument
+from protocol import (FRAME_MARKER, FRAME_FIRST, FRAME_LAST, FRAME_HEADER_SIZE, DEFAULT_MTU,
+                      get_mtu)
+
+logger = logging.getLogger(__name__)
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
@@ -36,6 +46,9 @@ GATT_SERVICE_IFACE = "org.bluez.GattService1"
 GATT_CHRC_IFACE =    "org.bluez.GattCharacteristic1"
 GATT_DESC_IFACE =    "org.bluez.GattDescriptor1"
 
+INSTRUMENTED_METHODS = ("ReadValue", "WriteValue", "StartNotify", "StopNotify",
+                        "AcquireNotify", "AcquireWrite")
+
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
 
@@ -45,6 +58,19 @@ class NotSupportedException(dbus.exceptions.DBusException):
 class NotPermittedException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.bluez.Error.NotPermitted"
 
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidOffset"
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
+
+class FailedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.Failed"
+
+MAX_WRITE_SIZE = 4096
+WRITE_SETTLE_MS = 100
+ATT_PREPARE_WRITE_OVERHEAD = 5
+
 class Application(dbus.service.Object):
     def __init__(self):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -53,6 +79,9 @@ class Application(dbus.service.Object):
         self.path = "/"
         self.services = []
         self.next_index = 0
+        self.managed_objects = None
+        self.sessions = SessionManager(self.bus)
+        self.notifications = NotificationScheduler()
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_path(self):
@@ -60,27 +89,44 @@ class Application(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.object_added(service)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        service.application = None
+        self.managed_objects = None
+        for path, interfaces in service.get_managed_objects().items():
+            self.InterfacesRemoved(path, dbus.Array(interfaces.keys(), signature='s'))
+
+    def object_added(self, obj):
+        self.managed_objects = None
+        for path, interfaces in obj.get_managed_objects().items():
+            self.InterfacesAdded(path, interfaces)
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature = "a{oa{sa{sv}}}")
     def GetManagedObjects(self):
-        response = {}
+        if self.managed_objects is None:
+            response = {}
+            for service in self.services:
+                response.update(service.get_managed_objects())
+            self.managed_objects = response
 
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
+        return self.managed_objects
 
-        return response
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    @dbus.service.signal(DBUS_OM_IFACE, signature='oas')
+    def InterfacesRemoved(self, path, interfaces):
+        pass
 
     def register_app_callback(self):
-        print("GATT application registered")
+        logger.info("GATT application registered")
 
     def register_app_error_callback(self, error):
-        print("Failed to register application: " + str(error))
+        logger.error(f"Failed to register application: {error}")
 
     def register(self):
         adapter = BleTools.find_adapter(self.bus)
@@ -97,7 +143,7 @@ class Application(dbus.service.Object):
         self.mainloop.run()
 
     def quit(self):
-        print("\nGATT application terminated")
+        logger.info("GATT application terminated")
         self.mainloop.quit()
 
 class Service(dbus.service.Object):
@@ -110,6 +156,7 @@ class Service(dbus.service.Object):
         self.primary = primary
         self.characteristics = []
         self.next_index = 0
+        self.application = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
@@ -128,6 +175,14 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        if self.application is not None:
+            self.application.object_added(characteristic)
+
+    def get_managed_objects(self):
+        response = {self.get_path(): self.get_properties()}
+        for chrc in self.characteristics:
+            response.update(chrc.get_managed_objects())
+        return response
 
     def get_characteristic_paths(self):
         result = []
@@ -156,10 +211,63 @@ class Service(dbus.service.Object):
 
         return self.get_properties()[GATT_SERVICE_IFACE]
 
+class WriteBuffer(object):
+    __slots__ = ("data", "length", "next_seq", "timer")
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.length = 0
+        self.next_seq = 0
+        self.timer = None
+
+    def append(self, value):
+        end = self.length + len(value)
+        if end > len(self.data):
+            raise InvalidValueLengthException()
+        self.data[self.length:end] = value
+        self.length = end
+
+    def message(self):
+        return bytes(self.data[:self.length])
+
 class Characteristic(dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Characteristics with a slowly changing value implement get_value() and
+    return read_cached_value() from ReadValue. The encoded bytes are kept
+    until value_ttl seconds pass (None keeps them until invalidate_value()).
+
+    Characteristics taking messages longer than one ATT write pass each
+    fragment to assemble_write(), which calls the handler once per message.
+
+    Setting acquire_notify / acquire_write lets BlueZ hand notifications and
+    write commands over a socket instead of D-Bus (AcquireNotify and
+    AcquireWrite). Acquired writes are passed to acquired_write().
     """
+    value_ttl = None
+    max_write_size = MAX_WRITE_SIZE
+    acquire_notify = False
+    acquire_write = False
+
+    def __init_subclass__(cls, **kwargs):
+        # Record latency and errors of every GATT handler a subclass defines
+        super().__init_subclass__(**kwargs)
+        for method in INSTRUMENTED_METHODS:
+            func = cls.__dict__.get(method)
+            if func is None or getattr(func, "_metrics_instrumented", False):
+                continue
+            setattr(cls, method, instrument(func, "uuid", method,
+                                            cls.get_async_callbacks(method)))
+
+    @classmethod
+    def get_async_callbacks(cls, method):
+        for klass in cls.__mro__:
+            func = klass.__dict__.get(method)
+            if func is not None and getattr(func, "_dbus_is_method", False):
+                return func._dbus_async_callbacks
+        return None
+
     def __init__(self, uuid, flags, service):
         index = service.get_next_index()
         self.path = service.path + '/char' + str(index)
@@ -169,25 +277,47 @@ class Characteristic(dbus.service.Object):
         self.flags = flags
         self.descriptors = []
         self.next_index = 0
+        self.cached_value = None
+        self.cached_at = 0.0
+        self.notify_socket = None
+        self.notify_watch = None
+        # notifications go to every subscriber, so only the acquiring
+        # client's MTU is known to fit; otherwise assume the minimum
+        self.notify_mtu = DEFAULT_MTU
+        self.write_socket = None
+        self.write_watch = None
+        self.write_options = None
+        self.write_mtu = 0
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
+        properties = {
+                'Service': self.service.get_path(),
+                'UUID': self.uuid,
+                'Flags': self.flags,
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
         }
+        if self.acquire_notify:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_socket is not None)
+        if self.acquire_write:
+            properties['WriteAcquired'] = dbus.Boolean(self.write_socket is not None)
+        return {GATT_CHRC_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        if self.service.application is not None:
+            self.service.application.object_added(descriptor)
+
+    def get_managed_objects(self):
+        response = {self.get_path(): self.get_properties()}
+        for desc in self.descriptors:
+            response.update(desc.get_managed_objects())
+        return response
 
     def get_descriptor_paths(self):
         result = []
@@ -211,22 +341,22 @@ class Characteristic(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print('Default ReadValue called, returning error')
+        logger.warning('Default ReadValue called, returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        logger.warning('Default WriteValue called, returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        print('Default StartNotify called, returning error')
+        logger.warning('Default StartNotify called, returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        print('Default StopNotify called, returning error')
+        logger.warning('Default StopNotify called, returning error')
         raise NotSupportedException()
 
     @dbus.service.signal(DBUS_PROP_IFACE,
@@ -234,6 +364,135 @@ class Characteristic(dbus.service.Object):
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.acquire_notify:
+            raise NotSupportedException()
+        if self.notify_socket is not None:
+            raise NotPermittedException()
+
+        self.notify_socket, remote = self.acquire_socket()
+        self.notify_mtu = get_mtu(options)
+        self.notify_watch = GObject.io_add_watch(self.notify_socket.fileno(),
+                GObject.IO_HUP | GObject.IO_ERR, self.notify_released)
+        logger.debug(f"Notify acquired for {self.uuid}")
+        self.StartNotify()
+        self.acquired_changed("NotifyAcquired", True)
+        return self.hand_over(remote), dbus.UInt16(self.notify_mtu)
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireWrite(self, options):
+        if not self.acquire_write:
+            raise NotSupportedException()
+        if self.write_socket is not None:
+            raise NotPermittedException()
+
+        self.write_socket, remote = self.acquire_socket()
+        self.write_options = dict(options)
+        self.write_mtu = get_mtu(options)
+        self.write_watch = GObject.io_add_watch(self.write_socket.fileno(),
+                GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR, self.write_readable)
+        logger.debug(f"Write acquired for {self.uuid}")
+        self.acquired_changed("WriteAcquired", True)
+        return self.hand_over(remote), dbus.UInt16(self.write_mtu)
+
+    def acquire_socket(self):
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        local.setblocking(False)
+        return local, remote
+
+    def hand_over(self, remote):
+        fd = dbus.types.UnixFd(remote)
+        remote.close()
+        return fd
+
+    def notify_released(self, fd, condition):
+        self.notify_watch = None
+        self.release_notify()
+        return False
+
+    def release_notify(self):
+        if self.notify_socket is None:
+            return
+        if self.notify_watch is not None:
+            GObject.source_remove(self.notify_watch)
+            self.notify_watch = None
+        self.notify_socket.close()
+        self.notify_socket = None
+        self.notify_mtu = DEFAULT_MTU
+        logger.debug(f"Notify released for {self.uuid}")
+        self.StopNotify()
+        self.acquired_changed("NotifyAcquired", False)
+
+    def write_readable(self, fd, condition):
+        if condition & GObject.IO_IN:
+            try:
+                value = self.write_socket.recv(self.write_mtu)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                logger.warning(f"Reading acquired write for {self.uuid} failed: {e}")
+                value = b""
+            if value:
+                try:
+                    self.acquired_write(value, self.write_options)
+                except Exception as e:
+                    logger.error(f"Handling acquired write to {self.uuid} failed: {e!r}")
+                return True
+        self.write_watch = None
+        self.release_write()
+        return False
+
+    def release_write(self):
+        if self.write_socket is None:
+            return
+        if self.write_watch is not None:
+            GObject.source_remove(self.write_watch)
+            self.write_watch = None
+        self.write_socket.close()
+        self.write_socket = None
+        logger.debug(f"Write released for {self.uuid}")
+        self.acquired_changed("WriteAcquired", False)
+
+    def acquired_write(self, value, options):
+        self.WriteValue(value, options)
+
+    def acquired_changed(self, name, acquired):
+        # the property is part of the cached GetManagedObjects reply
+        application = self.service.application
+        if application is not None:
+            application.managed_objects = None
+        self.PropertiesChanged(GATT_CHRC_IFACE, {name: dbus.Boolean(acquired)}, [])
+
+    def notify(self, value, coalesce=True):
+        return self.service.application.notifications.submit(self, value, coalesce)
+
+    def when_drained(self, callback):
+        self.service.application.notifications.when_drained(self, callback)
+
+    def send_notification(self, value):
+        """
+        Sends one notification, over the acquired socket when there is one.
+        Returns False when the socket is full and the value should be retried.
+        """
+        if self.notify_socket is not None:
+            try:
+                self.notify_socket.send(value)
+            except BlockingIOError:
+                return False
+            except OSError as e:
+                logger.warning(f"Acquired notify for {self.uuid} failed: {e}")
+                self.release_notify()
+                return True
+        else:
+            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": dbus.ByteArray(value)}, [])
+        metrics.count(self.uuid, "notify")
+        return True
+
     def get_bus(self):
         bus = self.bus
 
@@ -245,8 +504,99 @@ class Characteristic(dbus.service.Object):
 
         return idx
 
+    def get_value(self):
+        logger.warning('Default get_value called, returning error')
+        raise NotSupportedException()
+
+    def read_cached_value(self):
+        if self.cached_value is None or (self.value_ttl is not None and
+                time.monotonic() - self.cached_at >= self.value_ttl):
+            self.cached_value = bytes(self.get_value())
+            self.cached_at = time.monotonic()
+        return self.cached_value
+
+    def invalidate_value(self):
+        self.cached_value = None
+
+    def get_session(self, options):
+        return self.service.application.sessions.get(options)
+
+    def assemble_write(self, value, options, handler):
+        """
+        Collects WriteValue fragments per device and calls handler(message,
+        options) with the complete message. Framed fragments (see
+        protocol.ChunkFramer) end at the frame with FRAME_LAST set. Unframed
+        long writes are placed at their `offset` and complete once no further
+        fragment arrives for WRITE_SETTLE_MS.
+        """
+        buffers = self.get_session(options).write_buffers
+        value = bytes(value)
+
+        if value and value[0] & FRAME_MARKER == FRAME_MARKER:
+            if len(value) < FRAME_HEADER_SIZE:
+                raise InvalidArgsException()
+            flags, seq = value[0], value[1]
+            buffer = buffers.get(self.path)
+            if flags & FRAME_FIRST:
+                self.drop_write_buffer(buffers)
+                buffer = buffers[self.path] = WriteBuffer(self.max_write_size)
+            elif buffer is None or seq != buffer.next_seq:
+                self.drop_write_buffer(buffers)
+                raise InvalidOffsetException()
+            try:
+                buffer.append(value[FRAME_HEADER_SIZE:])
+            except InvalidValueLengthException:
+                self.drop_write_buffer(buffers)
+                raise
+            buffer.next_seq = (seq + 1) & 0xFF
+            if flags & FRAME_LAST:
+                del buffers[self.path]
+                handler(buffer.message(), options)
+            return
+
+        offset = int(options.get("offset", 0))
+        buffer = buffers.get(self.path)
+        if buffer is None and offset == 0 and \
+                len(value) < get_mtu(options) - ATT_PREPARE_WRITE_OVERHEAD:
+            handler(value, options)
+            return
+
+        if buffer is None or offset == 0:
+            self.drop_write_buffer(buffers)
+            buffer = buffers[self.path] = WriteBuffer(self.max_write_size)
+        if offset != buffer.length:
+            self.drop_write_buffer(buffers)
+            raise InvalidOffsetException()
+        try:
+            buffer.append(value)
+        except InvalidValueLengthException:
+            self.drop_write_buffer(buffers)
+            raise
+
+        if buffer.timer is not None:
+            GObject.source_remove(buffer.timer)
+        buffer.timer = GObject.timeout_add(WRITE_SETTLE_MS, self.write_settled,
+                                           buffers, handler, options)
+
+    def write_settled(self, buffers, handler, options):
+        buffer = buffers.pop(self.path, None)
+        if buffer is not None:
+            try:
+                handler(buffer.message(), options)
+            except Exception as e:
+                logger.error(f"Handling write to {self.uuid} failed: {e!r}")
+        return False
+
+    def drop_write_buffer(self, buffers):
+        buffer = buffers.pop(self.path, None)
+        if buffer is not None and buffer.timer is not None:
+            GObject.source_remove(buffer.timer)
+
     def add_timeout(self, timeout, callback):
-        GObject.timeout_add(timeout, callback)
+        return GObject.timeout_add(timeout, callback)
+
+    def remove_timeout(self, source_id):
+        GObject.source_remove(source_id)
 
 
 class Descriptor(dbus.service.Object):
@@ -271,6 +621,9 @@ class Descriptor(dbus.service.Object):
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def get_managed_objects(self):
+        return {self.get_path(): self.get_properties()}
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -284,12 +637,12 @@ class Descriptor(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        print ('Default ReadValue called, returning error')
+        logger.warning('Default ReadValue called, returning error')
         raise NotSupportedException()
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        print('Default WriteValue called, returning error')
+        logger.warning('Default WriteValue called, returning error')
         raise NotSupportedException()
 
 
@@ -0,0 +1,88 @@
+import collections
+import logging
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+logger = logging.getLogger(__name__)
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+DEVICE_IFACE = "org.bluez.Device1"
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+MAX_SESSIONS = 16
+LOCAL_DEVICE = ""
+
+
+class Session(object):
+    """
+    State owned by one connected central: partial writes, per-device
+    values such as terminal output and running terminal commands, keyed by
+    characteristic path. Commands still running on release are killed.
+    """
+    __slots__ = ("device", "write_buffers", "values", "commands")
+
+    def __init__(self, device):
+        self.device = device
+        self.write_buffers = {}
+        self.values = {}
+        self.commands = {}
+
+    def release(self):
+        for buffer in self.write_buffers.values():
+            if buffer.timer is not None:
+                GObject.source_remove(buffer.timer)
+        self.write_buffers.clear()
+        self.values.clear()
+        for command in self.commands.values():
+            command.kill()
+        self.commands.clear()
+
+
+class SessionManager(object):
+    """
+    Hands out a Session per BlueZ device path and releases it when BlueZ
+    reports the device as disconnected or removed. At most `max_sessions`
+    are kept; the least recently used one is released beyond that.
+    """
+    def __init__(self, bus, max_sessions=MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+        bus.add_signal_receiver(self.device_properties_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROP_IFACE,
+                bus_name=BLUEZ_SERVICE_NAME,
+                arg0=DEVICE_IFACE,
+                path_keyword="path")
+        bus.add_signal_receiver(self.interfaces_removed,
+                signal_name="InterfacesRemoved",
+                dbus_interface=DBUS_OM_IFACE,
+                bus_name=BLUEZ_SERVICE_NAME)
+
+    def get(self, options):
+        device = str(options.get("device", LOCAL_DEVICE))
+        session = self.sessions.get(device)
+        if session is None:
+            session = self.sessions[device] = Session(device)
+            logger.debug(f"Session opened for {device}")
+            while len(self.sessions) > self.max_sessions:
+                self.release(next(iter(self.sessions)))
+        else:
+            self.sessions.move_to_end(device)
+        return session
+
+    def release(self, device):
+        session = self.sessions.pop(device, None)
+        if session is not None:
+            logger.debug(f"Session released for {device}")
+            session.release()
+
+    def device_properties_changed(self, interface, changed, invalidated, path=None):
+        if "Connected" in changed and not changed["Connected"]:
+            self.release(str(path))
+
+    def interfaces_removed(self, path, interfaces):
+        if DEVICE_IFACE in interfaces:
+            self.release(str(path))
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+import api
+from executor import executor
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_PATH = "/var/lib/vps-ble/settings.json"
+BATCH_WINDOW_MS = 250
+
+# settings section: api call that applies it
+SECTIONS = {
+    "recording": api.update_blyqt_recording_settings,
+    "hmi": api.update_blyqt_miscellaneous_settings,
+}
+
+# settings section: keys its api call reads
+REQUIRED_KEYS = {
+    "recording": frozenset(api.RECORDING_SETTINGS_FIELDS),
+    "hmi": frozenset(api.MISCELLANEOUS_SETTINGS_FIELDS),
+}
+
+
+class SettingsManager(object):
+    """
+    Applies recorder settings written over BLE. Writes arriving within
+    BATCH_WINDOW_MS are merged, each section is compared with the last
+    successfully applied one, and only changed sections are sent to the
+    recorder API. The applied settings are persisted to `path`. A partial
+    section is only accepted once earlier writes or the applied settings
+    provide the rest of its keys.
+    """
+    def __init__(self, path=SETTINGS_PATH, window_ms=BATCH_WINDOW_MS):
+        self.path = path
+        self.window_ms = window_ms
+        self.applied = self.load()
+        self.pending = {}
+        self.callbacks = []
+        self.timer = None
+        self.flushing = False
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.error(f"Loading settings from {self.path} failed: {e}")
+            return {}
+
+    def update(self, settings_json, callback):
+        for section, values in settings_json.items():
+            if section not in SECTIONS:
+                raise KeyError(f"Unknown settings section: {section}")
+            missing = (REQUIRED_KEYS[section] - set(self.applied.get(section, ()))
+                       - set(self.pending.get(section, ())) - set(values))
+            if missing:
+                raise KeyError(f"Settings section {section} lacks {', '.join(sorted(missing))}")
+        for section, values in settings_json.items():
+            self.pending.setdefault(section, {}).update(values)
+        self.callbacks.append(callback)
+        if self.timer is None and not self.flushing:
+            self.timer = GObject.timeout_add(self.window_ms, self.flush)
+
+    def flush(self):
+        self.timer = None
+        pending, self.pending = self.pending, {}
+        callbacks, self.callbacks = self.callbacks, []
+
+        changes = {}
+        for section, values in pending.items():
+            merged = dict(self.applied.get(section, {}))
+            merged.update(values)
+            if merged != self.applied.get(section):
+                changes[section] = merged
+
+        if not changes:
+            logger.debug("Settings unchanged, nothing to send")
+            for callback in callbacks:
+                callback(True)
+            return False
+
+        def on_done(result):
+            self.applied, ok = result
+            self.finish(callbacks, ok)
+
+        def on_error(error):
+            logger.error(f"Applying settings failed: {error!r}")
+            self.finish(callbacks, False)
+
+        self.flushing = True
+        executor.submit(self.apply, dict(self.applied), changes,
+                        callback=on_done, error_callback=on_error)
+        return False
+
+    def apply(self, applied, changes):
+        ok = True
+        for section, merged in changes.items():
+            logger.info(f"Sending changed settings section: {section}")
+            if SECTIONS[section]({section: merged}):
+                applied[section] = merged
+            else:
+                ok = False
+        self.save(applied)
+        return applied, ok
+
+    def save(self, applied):
+        tmp_path = self.path + ".tmp"
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(applied, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Saving settings to {self.path} failed: {e}")
+
+    def finish(self, callbacks, ok):
+        self.flushing = False
+        for callback in callbacks:
+            callback(ok)
+        if self.pending and self.timer is None:
+            self.timer = GObject.timeout_add(self.window_ms, self.flush)
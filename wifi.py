@@ -0,0 +1,283 @@
+import logging
+import dbus
+import dbus.exceptions
+
+logger = logging.getLogger(__name__)
+
+NM_SERVICE_NAME = "org.freedesktop.NetworkManager"
+NM_OBJECT_PATH = "/org/freedesktop/NetworkManager"
+NM_IFACE = "org.freedesktop.NetworkManager"
+NM_DEVICE_IFACE = "org.freedesktop.NetworkManager.Device"
+NM_WIRELESS_IFACE = "org.freedesktop.NetworkManager.Device.Wireless"
+NM_AP_IFACE = "org.freedesktop.NetworkManager.AccessPoint"
+NM_ACTIVE_CONNECTION_IFACE = "org.freedesktop.NetworkManager.Connection.Active"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+NM_DEVICE_TYPE_WIFI = 2
+NO_OBJECT = "/"
+
+NM_802_11_AP_FLAGS_PRIVACY = 0x1
+NM_802_11_AP_SEC_KEY_MGMT_PSK = 0x100
+NM_802_11_AP_SEC_KEY_MGMT_802_1X = 0x200
+NM_802_11_AP_SEC_KEY_MGMT_SAE = 0x400
+NM_802_11_AP_SEC_KEY_MGMT_OWE = 0x800
+WEP_KEY_LENGTHS = (5, 10, 13, 26)
+NM_WEP_KEY_TYPE_KEY = 1
+NM_WEP_KEY_TYPE_PASSPHRASE = 2
+
+
+def key_management(flags, wpa_flags, rsn_flags):
+    """
+    Returns the NetworkManager key-mgmt for an access point's flags, None for
+    an open network. Transition mode networks that offer both PSK and SAE
+    use PSK, which every supplicant supports.
+    """
+    sec_flags = wpa_flags | rsn_flags
+    if sec_flags & NM_802_11_AP_SEC_KEY_MGMT_PSK:
+        return "wpa-psk"
+    if sec_flags & NM_802_11_AP_SEC_KEY_MGMT_SAE:
+        return "sae"
+    if sec_flags & NM_802_11_AP_SEC_KEY_MGMT_802_1X:
+        return "wpa-eap"
+    if sec_flags & NM_802_11_AP_SEC_KEY_MGMT_OWE:
+        return "owe"
+    if flags & NM_802_11_AP_FLAGS_PRIVACY:
+        return "none"
+    return None
+
+
+def security_settings(key_mgmt, password):
+    if key_mgmt in ("wpa-psk", "sae"):
+        return {"key-mgmt": dbus.String(key_mgmt), "psk": dbus.String(password)}
+    if key_mgmt == "none":
+        key_type = (NM_WEP_KEY_TYPE_KEY if len(password) in WEP_KEY_LENGTHS
+                    else NM_WEP_KEY_TYPE_PASSPHRASE)
+        return {
+            "key-mgmt": dbus.String("none"),
+            "wep-key0": dbus.String(password),
+            "wep-key-type": dbus.UInt32(key_type),
+        }
+    return {"key-mgmt": dbus.String(key_mgmt)}
+
+
+class WifiManager(object):
+    """
+    NetworkManager backend for the Wi-Fi characteristics. The SSID of the
+    active access point is cached and kept current from NetworkManager
+    signals, and connect requests run as async AddAndActivateConnection2
+    calls that add a volatile profile, so NetworkManager forgets it again
+    once the connection is deactivated or fails.
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        # Following the owner keeps the proxy working across NetworkManager restarts
+        self.nm = bus.get_object(NM_SERVICE_NAME, NM_OBJECT_PATH, introspect=False,
+                                 follow_name_owner_changes=True)
+        self.device = None
+        self.access_point = None
+        self.ssid = None
+        self.listeners = []
+        self.device_state_listeners = []
+
+    def start(self, callback=None):
+        """
+        Finds the Wi-Fi device with async calls, so probing NetworkManager
+        overlaps with the rest of startup. `callback` runs once the device
+        is known, or known to be missing.
+        """
+        def on_error(error):
+            logger.error(f"Probing NetworkManager failed: {error}")
+            if callback:
+                callback()
+
+        self.nm.GetDevices(dbus_interface=NM_IFACE,
+                reply_handler=lambda paths: self.probe_devices(list(paths), callback),
+                error_handler=on_error)
+
+    def probe_devices(self, paths, callback):
+        if not paths:
+            logger.warning("No Wi-Fi device found")
+            if callback:
+                callback()
+            return
+
+        path = paths.pop(0)
+
+        def on_device_type(device_type):
+            if device_type == NM_DEVICE_TYPE_WIFI:
+                self.device_found(path, callback)
+            else:
+                self.probe_devices(paths, callback)
+
+        self.get_property_async(path, NM_DEVICE_IFACE, "DeviceType", on_device_type,
+                                lambda error: self.probe_devices(paths, callback))
+
+    def device_found(self, path, callback):
+        self.device = path
+        self.bus.add_signal_receiver(self.device_properties_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROP_IFACE,
+                path=self.device)
+        self.bus.add_signal_receiver(self.device_state_changed,
+                signal_name="StateChanged",
+                dbus_interface=NM_DEVICE_IFACE,
+                path=self.device)
+        self.get_property_async(self.device, NM_WIRELESS_IFACE, "ActiveAccessPoint",
+                                self.set_access_point)
+        if callback:
+            callback()
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def add_device_state_listener(self, callback):
+        self.device_state_listeners.append(callback)
+
+    def get_property_async(self, path, interface, name, callback, error_callback=None):
+        def on_error(error):
+            logger.error(f"Reading {name} of {path} failed: {error}")
+            if error_callback:
+                error_callback(error)
+
+        self.bus.get_object(NM_SERVICE_NAME, path, introspect=False).Get(
+                interface, name,
+                dbus_interface=DBUS_PROP_IFACE,
+                reply_handler=callback,
+                error_handler=on_error)
+
+    def device_state_changed(self, new_state, old_state, reason):
+        for listener in self.device_state_listeners:
+            listener(int(new_state), int(reason))
+
+    def device_properties_changed(self, interface, changed, invalidated):
+        if interface == NM_WIRELESS_IFACE and "ActiveAccessPoint" in changed:
+            self.set_access_point(changed["ActiveAccessPoint"])
+
+    def set_access_point(self, path):
+        path = str(path)
+        self.access_point = path
+        if path == NO_OBJECT:
+            self.set_ssid(None)
+            return
+
+        def on_ssid(ssid):
+            if self.access_point == path:
+                self.set_ssid(bytes(ssid).decode("utf-8", "replace"))
+
+        def on_error(error):
+            logger.error(f"Reading SSID of {path} failed: {error}")
+
+        self.bus.get_object(NM_SERVICE_NAME, path).Get(
+                NM_AP_IFACE, "Ssid",
+                dbus_interface=DBUS_PROP_IFACE,
+                reply_handler=on_ssid,
+                error_handler=on_error)
+
+    def set_ssid(self, ssid):
+        if ssid == self.ssid:
+            return
+        self.ssid = ssid
+        logger.info(f"Wi-Fi SSID is now {ssid}")
+        for listener in self.listeners:
+            listener(ssid)
+
+    def connect(self, ssid, password, callback, error_callback):
+        if self.device is None:
+            error_callback(dbus.exceptions.DBusException("No Wi-Fi device found"))
+            return
+
+        def on_access_point(path, properties):
+            self.add_and_activate(ssid, password, path, properties, callback, error_callback)
+
+        self.find_access_point(ssid, on_access_point)
+
+    def find_access_point(self, ssid, callback):
+        """
+        Calls `callback(path, properties)` with the first access point that
+        advertises `ssid`, or `callback(None, None)` if none does.
+        """
+        ssid = ssid.encode("utf-8")
+
+        def probe(paths):
+            if not paths:
+                callback(None, None)
+                return
+            path = str(paths.pop(0))
+
+            def on_properties(properties):
+                if bytes(properties.get("Ssid", b"")) == ssid:
+                    callback(path, properties)
+                else:
+                    probe(paths)
+
+            self.bus.get_object(NM_SERVICE_NAME, path, introspect=False).GetAll(
+                    NM_AP_IFACE,
+                    dbus_interface=DBUS_PROP_IFACE,
+                    reply_handler=on_properties,
+                    error_handler=lambda error: probe(paths))
+
+        def on_error(error):
+            logger.error(f"Listing access points failed: {error}")
+            callback(None, None)
+
+        self.bus.get_object(NM_SERVICE_NAME, self.device, introspect=False).GetAllAccessPoints(
+                dbus_interface=NM_WIRELESS_IFACE,
+                reply_handler=lambda paths: probe(list(paths)),
+                error_handler=on_error)
+
+    def add_and_activate(self, ssid, password, access_point, properties,
+                         callback, error_callback):
+        wireless = {
+            "ssid": dbus.ByteArray(ssid.encode("utf-8")),
+            "mode": dbus.String("infrastructure"),
+        }
+        if access_point is None:
+            # not in the scan results, so it may be a hidden network
+            wireless["hidden"] = dbus.Boolean(True)
+            key_mgmt = "wpa-psk" if password else None
+        else:
+            key_mgmt = key_management(int(properties.get("Flags", 0)),
+                                      int(properties.get("WpaFlags", 0)),
+                                      int(properties.get("RsnFlags", 0)))
+        if key_mgmt == "wpa-eap":
+            error_callback(dbus.exceptions.DBusException(
+                    f"{ssid} needs 802.1X authentication, which is not supported"))
+            return
+        if key_mgmt in ("wpa-psk", "sae", "none") and not password:
+            error_callback(dbus.exceptions.DBusException(f"{ssid} needs a password"))
+            return
+
+        settings = {
+            "connection": {
+                "id": dbus.String(ssid),
+                "type": dbus.String("802-11-wireless"),
+            },
+            "802-11-wireless": wireless,
+        }
+        if key_mgmt is not None:
+            settings["802-11-wireless-security"] = security_settings(key_mgmt, password)
+
+        self.nm.AddAndActivateConnection2(
+                dbus.Dictionary(settings, signature="sa{sv}"),
+                dbus.ObjectPath(self.device),
+                dbus.ObjectPath(access_point or NO_OBJECT),
+                dbus.Dictionary({"persist": dbus.String("volatile")}, signature="sv"),
+                dbus_interface=NM_IFACE,
+                reply_handler=lambda connection, active, result: callback(active),
+                error_handler=error_callback)
+
+    def watch_active_connection(self, active, callback):
+        return self.bus.add_signal_receiver(
+                lambda state, reason: callback(int(state), int(reason)),
+                signal_name="StateChanged",
+                dbus_interface=NM_ACTIVE_CONNECTION_IFACE,
+                path=active)
+
+    def deactivate(self, active):
+        def on_error(error):
+            logger.warning(f"Deactivating {active} failed: {error}")
+
+        self.nm.DeactivateConnection(dbus.ObjectPath(active),
+                dbus_interface=NM_IFACE,
+                reply_handler=lambda: None,
+                error_handler=on_error)
@@ -0,0 +1,146 @@
+import logging
+import dbus
+try:
+  from gi.repository import GObject
+except ImportError:
+    import gobject as GObject
+
+from protocol import (encode_access_point, AP_SECURITY_PRIVACY, AP_SECURITY_WPA,
+                      AP_SECURITY_RSN)
+from wifi import (NM_SERVICE_NAME, NM_WIRELESS_IFACE, NM_AP_IFACE, DBUS_PROP_IFACE,
+                  NM_802_11_AP_FLAGS_PRIVACY)
+
+logger = logging.getLogger(__name__)
+
+SCAN_INTERVAL_MS = 30000
+SCAN_SETTLE_MS = 500
+STRENGTH_STEP = 5
+
+
+class WifiScanner(object):
+    """
+    Keeps an encoded record for every access point NetworkManager sees. The
+    list follows AccessPointAdded/AccessPointRemoved and access point property
+    changes, and while active a scan is requested every SCAN_INTERVAL_MS.
+    Listeners are called once per burst of changes.
+    """
+    def __init__(self, wifi, interval_ms=SCAN_INTERVAL_MS):
+        self.wifi = wifi
+        self.bus = wifi.bus
+        self.interval_ms = interval_ms
+        self.properties = {}
+        self.ids = {}
+        self.next_id = 0
+        self.records = {}
+        self.listeners = []
+        self.scan_timer = None
+        self.settle_timer = None
+
+    def start(self):
+        device = self.wifi.device
+        if device is None:
+            return
+
+        self.bus.add_signal_receiver(self.access_point_added,
+                signal_name="AccessPointAdded",
+                dbus_interface=NM_WIRELESS_IFACE,
+                path=device)
+        self.bus.add_signal_receiver(self.access_point_removed,
+                signal_name="AccessPointRemoved",
+                dbus_interface=NM_WIRELESS_IFACE,
+                path=device)
+        self.bus.add_signal_receiver(self.access_point_changed,
+                signal_name="PropertiesChanged",
+                dbus_interface=DBUS_PROP_IFACE,
+                bus_name=NM_SERVICE_NAME,
+                arg0=NM_AP_IFACE,
+                path_keyword="path")
+
+        def on_access_points(paths):
+            for path in paths:
+                self.access_point_added(path)
+
+        self.bus.get_object(NM_SERVICE_NAME, device).GetAllAccessPoints(
+                dbus_interface=NM_WIRELESS_IFACE,
+                reply_handler=on_access_points,
+                error_handler=self.log_error)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def set_active(self, active):
+        if active and self.scan_timer is None:
+            self.request_scan()
+            self.scan_timer = GObject.timeout_add(self.interval_ms, self.request_scan)
+        elif not active and self.scan_timer is not None:
+            GObject.source_remove(self.scan_timer)
+            self.scan_timer = None
+
+    def request_scan(self):
+        self.bus.get_object(NM_SERVICE_NAME, self.wifi.device).RequestScan(
+                dbus.Dictionary({}, signature="sv"),
+                dbus_interface=NM_WIRELESS_IFACE,
+                reply_handler=lambda: None,
+                error_handler=self.log_error)
+        return True
+
+    def access_point_added(self, path):
+        path = str(path)
+
+        def on_properties(properties):
+            self.properties[path] = dict(properties)
+            self.update_record(path)
+
+        self.bus.get_object(NM_SERVICE_NAME, path).GetAll(
+                NM_AP_IFACE,
+                dbus_interface=DBUS_PROP_IFACE,
+                reply_handler=on_properties,
+                error_handler=self.log_error)
+
+    def access_point_removed(self, path):
+        path = str(path)
+        self.properties.pop(path, None)
+        ap_id = self.ids.pop(path, None)
+        if ap_id is not None and self.records.pop(ap_id, None) is not None:
+            self.changed()
+
+    def access_point_changed(self, interface, changed, invalidated, path=None):
+        path = str(path)
+        if path in self.properties:
+            self.properties[path].update(changed)
+            self.update_record(path)
+
+    def update_record(self, path):
+        properties = self.properties[path]
+        security = 0
+        if properties.get("Flags", 0) & NM_802_11_AP_FLAGS_PRIVACY:
+            security |= AP_SECURITY_PRIVACY
+        if properties.get("WpaFlags", 0):
+            security |= AP_SECURITY_WPA
+        if properties.get("RsnFlags", 0):
+            security |= AP_SECURITY_RSN
+        strength = int(properties.get("Strength", 0)) // STRENGTH_STEP * STRENGTH_STEP
+
+        if path not in self.ids:
+            self.ids[path] = self.next_id
+            self.next_id = (self.next_id + 1) & 0xFFFF
+        ap_id = self.ids[path]
+        record = encode_access_point(ap_id, bytes(properties.get("Ssid", b"")),
+                                     strength, security,
+                                     int(properties.get("Frequency", 0)))
+        if self.records.get(ap_id) != record:
+            self.records[ap_id] = record
+            self.changed()
+
+    def changed(self):
+        if self.settle_timer is None:
+            self.settle_timer = GObject.timeout_add(SCAN_SETTLE_MS, self.notify_listeners)
+
+    def notify_listeners(self):
+        self.settle_timer = None
+        for listener in self.listeners:
+            listener()
+        return False
+
+    def log_error(self, error):
+        logger.error(f"Wi-Fi scan request failed: {error}")